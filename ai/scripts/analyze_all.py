@@ -14,6 +14,7 @@ from psycopg2.extras import RealDictCursor
 import os
 from dotenv import load_dotenv
 import warnings
+from competitor_rollup import competitor_summary_sql
 warnings.filterwarnings('ignore')
 
 # Carregar variáveis de ambiente
@@ -150,19 +151,7 @@ class InsightsGenerator:
             WHERE p.active = true
             AND p.marketplace = 'amazon'
         ),
-        competitor_pricing AS (
-            SELECT 
-                ct.asin,
-                MIN(ct.price) as min_competitor_price,
-                AVG(ct.price) as avg_competitor_price,
-                COUNT(DISTINCT ct.competitor_seller_id) as competitor_count,
-                COUNT(*) FILTER (WHERE ct.is_buy_box_winner) as buy_box_wins,
-                MAX(CASE WHEN ct.is_buy_box_winner THEN ct.price END) as buy_box_price,
-                MAX(CASE WHEN ct.is_buy_box_winner THEN ct.seller_name END) as buy_box_seller
-            FROM competitor_tracking_advanced ct
-            WHERE ct.timestamp >= NOW() - INTERVAL '%s hours'
-            GROUP BY ct.asin
-        ),
+        competitor_pricing AS ({competitor_pricing}),
         sales_data AS (
             SELECT 
                 asin,
@@ -192,11 +181,12 @@ class InsightsGenerator:
             (cp.buy_box_percentage < 70 AND comp.min_competitor_price < cp.our_price)
             OR (comp.buy_box_price < cp.our_price * 0.95)
         )
-        """ % lookback_hours
+        """.format(competitor_pricing=competitor_summary_sql())
         
+        # Competidores vêm do rollup horário (atualizado pelo worker, ver competitor_rollup.py)
         with self.get_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(query)
+                cursor.execute(query, (lookback_hours,))
                 results = cursor.fetchall()
                 
         for row in results:
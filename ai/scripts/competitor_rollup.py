@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Rollup horário incremental de preços de competidores
+Agrega competitor_tracking_advanced por ASIN e hora em competitor_price_hourly,
+processando só as linhas com id acima da última marca d'água. O worker
+atualiza o rollup antes das análises, e price_optimization.py e
+analyze_all.py só leem dele, então o custo da agregação cresce com os dados
+novos e não com o histórico inteiro.
+"""
+
+import sys
+import json
+import psycopg2
+from psycopg2.extras import RealDictCursor
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROLLUP_NAME = 'competitor_price_hourly'
+
+# Agrega um intervalo de ids e funde com as horas já existentes
+REFRESH_QUERY = """
+WITH new_rows AS (
+    SELECT
+        asin,
+        date_trunc('hour', timestamp) as hour,
+        competitor_seller_id,
+        seller_name,
+        price,
+        is_buy_box_winner
+    FROM competitor_tracking_advanced
+    WHERE id > %(last_id)s AND id <= %(max_id)s
+    AND asin IS NOT NULL
+    AND timestamp IS NOT NULL
+)
+INSERT INTO competitor_price_hourly AS r (
+    asin, hour, min_price, price_sum, price_count,
+    buy_box_wins, buy_box_price, buy_box_seller, seller_ids
+)
+SELECT
+    asin,
+    hour,
+    MIN(price),
+    COALESCE(SUM(price), 0),
+    COUNT(price),
+    COUNT(*) FILTER (WHERE is_buy_box_winner),
+    MAX(CASE WHEN is_buy_box_winner THEN price END),
+    MAX(CASE WHEN is_buy_box_winner THEN seller_name END),
+    ARRAY_REMOVE(ARRAY_AGG(DISTINCT competitor_seller_id::text), NULL)
+FROM new_rows
+GROUP BY asin, hour
+ON CONFLICT (asin, hour) DO UPDATE SET
+    min_price = LEAST(r.min_price, EXCLUDED.min_price),
+    price_sum = r.price_sum + EXCLUDED.price_sum,
+    price_count = r.price_count + EXCLUDED.price_count,
+    buy_box_wins = r.buy_box_wins + EXCLUDED.buy_box_wins,
+    buy_box_price = GREATEST(r.buy_box_price, EXCLUDED.buy_box_price),
+    buy_box_seller = GREATEST(r.buy_box_seller, EXCLUDED.buy_box_seller),
+    seller_ids = ARRAY(SELECT DISTINCT unnest(r.seller_ids || EXCLUDED.seller_ids))
+"""
+
+
+def check_rollup_tables(conn):
+    """Falha com uma mensagem clara se a migration 009 não foi aplicada"""
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("SELECT to_regclass('competitor_rollup_state') IS NOT NULL AS ready")
+        ready = cursor.fetchone()['ready']
+    conn.commit()
+    if not ready:
+        raise RuntimeError(
+            'competitor_rollup_state not found: apply migration 009 (scripts/runMigration009.js)'
+        )
+
+
+def safe_max_id(conn):
+    """Maior id que pode ser agregado sem pular linhas.
+    
+    Um id baixo pode ainda estar em uma transação aberta quando ids maiores
+    já estão visíveis; avançar a marca d'água até MAX(id) perderia essa
+    linha para sempre. Por isso cada MAX(id) lido vira um candidato junto
+    com o xmax do snapshot da leitura, e só é liberado quando o xmin do
+    snapshot atual passa desse xmax, isto é, quando todas as transações
+    abertas na leitura já terminaram. Sem transações longas o candidato é
+    liberado na hora; com elas, na próxima atualização. Retorna None se
+    nada pode ser liberado ainda.
+    """
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("""
+            SELECT
+                COALESCE(MAX(id), 0) AS candidate_id,
+                pg_snapshot_xmax(pg_current_snapshot())::text::bigint AS candidate_xid
+            FROM competitor_tracking_advanced
+        """)
+        row = cursor.fetchone()
+        candidate_id, candidate_xid = row['candidate_id'], row['candidate_xid']
+        conn.commit()
+        
+        # Transação nova, ainda sem xid próprio: o xmin é a transação aberta mais antiga
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS horizon")
+        horizon = cursor.fetchone()['horizon']
+        cursor.execute(
+            "SELECT pending_id, pending_xid FROM competitor_rollup_state WHERE name = %s FOR UPDATE",
+            (ROLLUP_NAME,)
+        )
+        row = cursor.fetchone()
+        pending_id, pending_xid = row['pending_id'], row['pending_xid']
+        
+        if horizon >= candidate_xid:
+            max_id, pending_id, pending_xid = candidate_id, None, None
+        elif pending_xid is not None and horizon >= pending_xid:
+            max_id, pending_id, pending_xid = pending_id, candidate_id, candidate_xid
+        else:
+            max_id = None
+            if pending_xid is None:
+                pending_id, pending_xid = candidate_id, candidate_xid
+                
+        cursor.execute(
+            "UPDATE competitor_rollup_state SET pending_id = %s, pending_xid = %s WHERE name = %s",
+            (pending_id, pending_xid, ROLLUP_NAME)
+        )
+    conn.commit()
+    return max_id
+
+
+def refresh_rollup(conn, batch_size=500000):
+    """Agrega as linhas novas de competitor_tracking_advanced.
+    
+    Processa ids acima da marca d'água até o limite seguro de safe_max_id,
+    em lotes de `batch_size`, cada lote em uma transação com a atualização
+    da marca (a linha de estado fica travada com FOR UPDATE, então
+    execuções simultâneas não duplicam somas). Linhas atrasadas caem na
+    hora certa, pois as horas se fundem. As tabelas vêm da migration 009,
+    aplicada pelo runner de migrations. Retorna {'rows_from_id', 'last_id',
+    'batches', 'pending_id'}.
+    """
+    check_rollup_tables(conn)
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(
+            "INSERT INTO competitor_rollup_state (name) VALUES (%s) ON CONFLICT (name) DO NOTHING",
+            (ROLLUP_NAME,)
+        )
+        conn.commit()
+        max_id = safe_max_id(conn)
+        
+        first_id = None
+        batches = 0
+        while True:
+            cursor.execute(
+                "SELECT last_id, pending_id FROM competitor_rollup_state WHERE name = %s FOR UPDATE",
+                (ROLLUP_NAME,)
+            )
+            row = cursor.fetchone()
+            last_id, pending_id = row['last_id'], row['pending_id']
+            first_id = last_id if first_id is None else first_id
+            if max_id is None or last_id >= max_id:
+                conn.commit()
+                break
+                
+            upper = min(max_id, last_id + batch_size)
+            cursor.execute(REFRESH_QUERY, {'last_id': last_id, 'max_id': upper})
+            cursor.execute(
+                "UPDATE competitor_rollup_state SET last_id = %s, updated_at = NOW() WHERE name = %s",
+                (upper, ROLLUP_NAME)
+            )
+            conn.commit()
+            batches += 1
+            
+    return {'rows_from_id': first_id, 'last_id': last_id, 'batches': batches, 'pending_id': pending_id}
+
+
+def competitor_summary_sql(per_day=False, filter_asins=False):
+    """SELECT dos agregados de competidores a partir do rollup.
+
+    Colunas: asin (e date, se `per_day`), min_competitor_price,
+    avg_competitor_price, competitor_count, buy_box_wins, buy_box_price e
+    buy_box_seller. Placeholders, nesta ordem: janela em horas e, com
+    `filter_asins`, a lista de ASINs. A granularidade é horária: a janela
+    começa no início da hora.
+    """
+    keys = 'r.asin, date(r.hour) as date' if per_day else 'r.asin'
+    group_by = '1, 2' if per_day else '1'
+    columns = 'asin, date' if per_day else 'asin'
+    asin_filter = 'AND r.asin = ANY(%s)' if filter_asins else ''
+    return f"""
+        WITH rollup AS (
+            SELECT r.*
+            FROM competitor_price_hourly r
+            WHERE r.hour >= date_trunc('hour', NOW() - INTERVAL '%s hours')
+            {asin_filter}
+        ),
+        prices AS (
+            SELECT
+                {keys},
+                MIN(r.min_price) as min_competitor_price,
+                SUM(r.price_sum) / NULLIF(SUM(r.price_count), 0) as avg_competitor_price,
+                SUM(r.buy_box_wins) as buy_box_wins,
+                MAX(r.buy_box_price) as buy_box_price,
+                MAX(r.buy_box_seller) as buy_box_seller
+            FROM rollup r
+            GROUP BY {group_by}
+        ),
+        sellers AS (
+            SELECT
+                {keys},
+                COUNT(DISTINCT s.seller_id) as competitor_count
+            FROM rollup r
+            CROSS JOIN LATERAL unnest(r.seller_ids) as s(seller_id)
+            GROUP BY {group_by}
+        )
+        SELECT
+            p.*,
+            COALESCE(s.competitor_count, 0) as competitor_count
+        FROM prices p
+        LEFT JOIN sellers s USING ({columns})
+    """
+
+
+def main():
+    """Função principal"""
+    # Ler input do Node.js
+    input_data = json.loads(sys.stdin.read())
+
+    if input_data.get('command') == 'refresh':
+        db_config = {
+            'host': os.getenv('DB_HOST', 'localhost'),
+            'port': os.getenv('DB_PORT', '5432'),
+            'database': os.getenv('DB_NAME', 'postgres'),
+            'user': os.getenv('DB_USER', 'postgres'),
+            'password': os.getenv('DB_PASSWORD')
+        }
+        params = input_data.get('params', {})
+        try:
+            with psycopg2.connect(**db_config) as conn:
+                result = {'success': True, 'data': refresh_rollup(conn, params.get('batch_size', 500000))}
+        except (RuntimeError, psycopg2.Error) as e:
+            result = {'success': False, 'error': str(e)}
+    else:
+        result = {
+            'success': False,
+            'error': f'Unknown command: {input_data.get("command")}'
+        }
+
+    # Retornar resultado
+    print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
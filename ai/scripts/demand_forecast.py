@@ -11,15 +11,909 @@ import numpy as np
 from datetime import datetime, timedelta
 from prophet import Prophet
 from prophet.diagnostics import cross_validation, performance_metrics
+from prophet.serialize import model_to_json, model_from_json
+from prophet.make_holidays import make_holidays_df
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import os
+import time
+import signal
+import threading
+import hashlib
+import itertools
+import csv
+import tempfile
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+import lightgbm as lgb
 from dotenv import load_dotenv
 import warnings
+from json_utils import json_safe
 warnings.filterwarnings('ignore')
 
 load_dotenv()
 
+MODEL_VERSION = '3.0'
+
+# Motores de previsão disponíveis em params.engine
+ENGINES = ('prophet', 'ets', 'lightgbm')
+
+# Configuração do Prophet; qualquer mudança aqui invalida o cache de modelos
+PROPHET_CONFIG = {
+    'growth': 'linear',  # ou 'logistic' se houver saturação
+    'changepoint_prior_scale': 0.05,
+    'seasonality_mode': 'multiplicative',
+    'yearly_seasonality': True,
+    'weekly_seasonality': True,
+    'daily_seasonality': False,
+    'interval_width': 0.95
+}
+
+# Modos de intervalo em params.interval_mode: amostragem do Prophet
+# (padrão), aproximação analítica ou quantis dos resíduos do ajuste
+INTERVAL_MODES = ('sampled', 'analytic', 'residual')
+UNCERTAINTY_SAMPLES = 1000  # Padrão do Prophet no modo 'sampled'
+
+CACHE_DIR = os.getenv(
+    'AI_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache')
+)
+
+
+# Versão do calendário de eventos; mudar ao alterar datas ou janelas
+EVENT_CALENDAR_VERSION = '1'
+
+_event_calendars = {}
+
+
+def event_calendar_years(today=None):
+    """Anos cobertos pelo calendário: histórico de 180 dias + horizonte"""
+    year = (today or datetime.now()).year
+    return list(range(year - 1, year + 2))
+
+
+def event_calendar_key(years):
+    return f'{EVENT_CALENDAR_VERSION}-{min(years)}-{max(years)}'
+
+
+def build_event_calendar(years):
+    """Feriados brasileiros e datas especiais de e-commerce no formato de
+    holidays do Prophet (holiday, ds, lower_window, upper_window)"""
+    # Feriados fixos
+    calendar = make_holidays_df(year_list=years, country='BR')
+    calendar['lower_window'] = 0
+    calendar['upper_window'] = 0
+    
+    # Datas especiais de e-commerce
+    events = []
+    for year in years:
+        # Black Friday (dia seguinte à quarta quinta de novembro), com os dias que antecedem
+        november_first = pd.Timestamp(year=year, month=11, day=1)
+        black_friday = november_first + pd.DateOffset(days=(3 - november_first.weekday()) % 7 + 22)
+        events.append(('black_friday', black_friday, -3, 1))
+        
+        # Cyber Monday
+        events.append(('cyber_monday', black_friday + pd.DateOffset(days=3), 0, 0))
+        
+        # Prime Day (geralmente em julho, dois dias)
+        events.append(('prime_day', pd.Timestamp(year=year, month=7, day=15), 0, 1))
+        
+    calendar = pd.concat([
+        calendar,
+        pd.DataFrame(events, columns=['holiday', 'ds', 'lower_window', 'upper_window'])
+    ], ignore_index=True)
+    calendar['ds'] = pd.to_datetime(calendar['ds'])
+    return calendar.sort_values(['ds', 'holiday']).reset_index(drop=True)
+
+
+def get_event_calendar(years=None, use_disk=True):
+    """Calendário de eventos compartilhado por todos os fits do processo.
+    
+    Construído uma vez por processo (os workers do pool herdam o do
+    processo pai) e, com `use_disk`, gravado em CACHE_DIR/event_calendar
+    para as próximas execuções.
+    """
+    years = years or event_calendar_years()
+    key = event_calendar_key(years)
+    if key in _event_calendars:
+        return _event_calendars[key]
+        
+    path = os.path.join(CACHE_DIR, 'event_calendar', f'{key}.csv')
+    calendar = None
+    if use_disk:
+        try:
+            calendar = pd.read_csv(path, parse_dates=['ds'])
+        except (OSError, ValueError):
+            calendar = None
+            
+    if calendar is None:
+        calendar = build_event_calendar(years)
+        if use_disk:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            calendar.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            
+    _event_calendars[key] = calendar
+    return calendar
+
+
+def event_indicators(calendar, dates):
+    """Matriz booleana (data × evento) com as janelas de cada evento ativas"""
+    dates = pd.DatetimeIndex(dates).normalize()
+    names = sorted(calendar['holiday'].unique())
+    position = {name: i for i, name in enumerate(names)}
+    matrix = np.zeros((len(dates), len(names)), dtype=bool)
+    
+    for event in calendar.itertuples(index=False):
+        for offset in range(int(event.lower_window), int(event.upper_window) + 1):
+            index = dates.get_indexer([event.ds + pd.Timedelta(days=offset)])[0]
+            if index >= 0:
+                matrix[index, position[event.holiday]] = True
+                
+    return names, matrix
+
+
+def model_config_key(version=MODEL_VERSION, config=PROPHET_CONFIG, calendar_key=None):
+    """Identificador de versão do modelo: model_version + hash da configuração
+    e do calendário de eventos"""
+    config_hash = hashlib.sha1(
+        json.dumps([config, calendar_key], sort_keys=True).encode()
+    ).hexdigest()[:10]
+    return f'v{version}-{config_hash}'
+
+
+def parse_shard(params):
+    """Lê shard_index/shard_count de `params`; (0, 1) quando não há sharding"""
+    shard_index = int(params.get('shard_index') or 0)
+    shard_count = int(params.get('shard_count') or 1)
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f'Invalid shard: shard_index={shard_index}, shard_count={shard_count}')
+    return shard_index, shard_count
+
+
+def shard_of(asin, shard_count):
+    """Shard do ASIN pelo md5; mesmo hash do filtro SQL de get_forecast_candidates"""
+    return int(hashlib.md5(asin.encode()).hexdigest()[:8], 16) % shard_count
+
+
+def shard_state_path(filename, shard=(0, 1)):
+    """Caminho do arquivo de estado no CACHE_DIR, separado por shard para que
+    execuções paralelas não sobrescrevam o mesmo JSON"""
+    shard_index, shard_count = shard
+    if shard_count > 1:
+        root, ext = os.path.splitext(filename)
+        filename = f'{root}.shard-{shard_index}-of-{shard_count}{ext}'
+    return os.path.join(CACHE_DIR, filename)
+
+
+class ForecastTimeout(Exception):
+    """Previsão de um ASIN passou do orçamento de tempo"""
+
+
+@contextmanager
+def time_budget(seconds):
+    """Levanta ForecastTimeout se o bloco passar de `seconds` segundos.
+    
+    Usa SIGALRM, então só vale na thread principal de sistemas com
+    setitimer; fora disso (ou com `seconds` vazio) o bloco roda sem limite.
+    """
+    if (not seconds or not hasattr(signal, 'setitimer')
+            or threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+        
+    def on_alarm(signum, frame):
+        raise ForecastTimeout(f'Exceeded time budget of {seconds}s')
+        
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class ProphetModelCache:
+    """Cache em disco de modelos Prophet treinados, por ASIN.
+    
+    Cada entrada guarda o modelo serializado e a série (ds, y) usada no
+    treino. Na busca:
+    - 'hit': a série é idêntica, o modelo pode ser reutilizado sem refit
+    - 'warm': a série só ganhou dias novos (ou perdeu os mais antigos da
+      janela), o modelo anterior serve de ponto de partida para o refit
+    - 'cold': sem entrada utilizável, treino do zero
+    
+    As entradas ficam em um subdiretório por versão (model_config_key), então
+    mudanças de configuração ou do calendário de eventos invalidam o cache.
+    Quando o tamanho total passa de `max_bytes`, evict() (chamado uma vez
+    por execução) remove as entradas usadas há mais tempo.
+    """
+    
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=512 * 1024 * 1024, model_key=None):
+        self.root = os.path.join(cache_dir, 'prophet_models')
+        self.path = os.path.join(self.root, model_key or model_config_key())
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+    
+    @staticmethod
+    def _series(df):
+        """Normaliza (ds, y) para comparação e fingerprint"""
+        ds = pd.to_datetime(df['ds']).dt.strftime('%Y-%m-%d').tolist()
+        y = [float(v) for v in df['y']]
+        return ds, y
+    
+    @classmethod
+    def fingerprint(cls, df):
+        """Hash da série de treino"""
+        ds, y = cls._series(df)
+        return hashlib.sha1(json.dumps([ds, y]).encode()).hexdigest()
+    
+    def _entry_path(self, asin):
+        return os.path.join(self.path, f'{asin}.json')
+    
+    def lookup(self, asin, df):
+        """Retorna (status, model) para a série `df` do ASIN"""
+        entry_path = self._entry_path(asin)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return 'cold', None
+            
+        ds, y = self._series(df)
+        if entry['fingerprint'] == self.fingerprint(df):
+            status = 'hit'
+        else:
+            # Dias em comum entre a série antiga e a nova devem ser idênticos
+            old = dict(zip(entry['ds'], entry['y']))
+            overlap = [(d, v) for d, v in zip(ds, y) if d in old]
+            old_overlap = [(d, v) for d, v in zip(entry['ds'], entry['y']) if d >= ds[0]]
+            if not overlap or overlap != old_overlap:
+                return 'cold', None
+            status = 'warm'
+            
+        try:
+            model = model_from_json(entry['model'])
+        except Exception:
+            return 'cold', None
+            
+        os.utime(entry_path)  # Marca uso recente para a evicção
+        return status, model
+    
+    def store(self, asin, df, model):
+        """Grava o modelo treinado"""
+        ds, y = self._series(df)
+        entry = {
+            'asin': asin,
+            'fingerprint': self.fingerprint(df),
+            'ds': ds,
+            'y': y,
+            'model': model_to_json(model),
+            'saved_at': datetime.now().isoformat()
+        }
+        
+        # Escrita atômica: vários processos podem gravar ao mesmo tempo
+        entry_path = self._entry_path(asin)
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, entry_path)
+    
+    def evict(self):
+        """Remove as entradas menos usadas até caber em max_bytes"""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue  # Escrita em andamento de outro processo
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class JsonStateFile:
+    """Estado pequeno persistido em JSON no diretório de cache"""
+    
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+    
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+
+class ForecastWatermarks(JsonStateFile):
+    """Marcas d'água por ASIN da última previsão gerada.
+    
+    Guarda a última data de venda e o checksum das linhas de sales_metrics
+    usadas na previsão, para que o modo incremental pule ASINs cujos dados
+    não mudaram desde então.
+    """
+    
+    def __init__(self, path=None):
+        super().__init__(path or os.path.join(CACHE_DIR, 'forecast_watermarks.json'))
+    
+    def is_current(self, product, forecast_days, max_staleness_days=7, engine='prophet'):
+        """True se a última previsão do ASIN ainda vale para `product`"""
+        mark = self.data.get(product['asin'])
+        if not mark or not product.get('sales_checksum'):
+            return False
+            
+        forecasted_at = datetime.fromisoformat(mark['forecasted_at'])
+        return (
+            mark['sales_checksum'] == product['sales_checksum']
+            and mark['last_sales_date'] == str(product['last_sales_date'])
+            and mark['model_version'] == MODEL_VERSION
+            and mark['forecast_days'] == forecast_days
+            and mark.get('engine', 'prophet') == engine
+            # O horizonte anda um dia por dia; não deixar a previsão envelhecer demais
+            and datetime.now() - forecasted_at < timedelta(days=max_staleness_days)
+        )
+    
+    def update(self, product, forecast_days, engine='prophet'):
+        self.data[product['asin']] = {
+            'engine': engine,
+            'last_sales_date': str(product['last_sales_date']),
+            'sales_checksum': product['sales_checksum'],
+            'model_version': MODEL_VERSION,
+            'forecast_days': forecast_days,
+            'forecasted_at': datetime.now().isoformat()
+        }
+
+
+class ForecastAccuracyCache(JsonStateFile):
+    """MAPE de validação cruzada por ASIN.
+    
+    Cada resultado vale enquanto a série de treino (fingerprint) e a versão
+    do modelo não mudarem; depois disso continua sendo o último valor
+    conhecido até o ASIN ser reavaliado.
+    """
+    
+    def __init__(self, path=None, model_key=None):
+        super().__init__(path or os.path.join(CACHE_DIR, 'forecast_mape.json'))
+        self.version = model_key or model_config_key()
+    
+    def get(self, asin):
+        return self.data.get(asin)
+    
+    def is_current(self, asin, fingerprint):
+        entry = self.data.get(asin)
+        return bool(entry) and entry['fingerprint'] == fingerprint and entry['version'] == self.version
+    
+    def update(self, asin, fingerprint, mape, cutoffs):
+        self.data[asin] = {
+            'fingerprint': fingerprint,
+            'version': self.version,
+            'mape': mape,
+            'cutoffs': cutoffs,
+            'evaluated_at': datetime.now().isoformat()
+        }
+
+
+def warm_start_params(model):
+    """Parâmetros de um modelo treinado no formato `init` do Stan"""
+    params = {}
+    for name in ['k', 'm', 'sigma_obs']:
+        params[name] = model.params[name][0][0]
+    for name in ['delta', 'beta']:
+        params[name] = model.params[name][0]
+    return params
+
+
+def analytic_intervals(model, forecast, interval_width=0.95):
+    """Intervalos do Prophet sem amostrar trajetórias.
+    
+    Aproxima a mesma simulação do predict: ruído de observação sigma_obs
+    mais a incerteza da tendência por changepoints futuros (processo de
+    Poisson com taxa S e deltas Laplace(0, lambda)), cuja variância em t > 1
+    é 2*S*lambda²*(t - 1)³/3 na escala do modelo. Com sazonalidade
+    multiplicativa, o desvio da tendência é escalado por (1 + termos
+    multiplicativos). Retorna (lower, upper).
+    """
+    z = NormalDist().inv_cdf(0.5 + interval_width / 2)
+    t = ((forecast['ds'] - model.start) / model.t_scale).to_numpy()
+    sigma_obs = float(np.ravel(model.params['sigma_obs'])[0])
+    deltas = np.asarray(model.params['delta'])[0]
+    lambda_ = np.mean(np.abs(deltas)) + 1e-8
+    rate = len(model.changepoints_t)
+    
+    future_t = np.maximum(t - 1, 0)
+    trend_variance = 2 * rate * lambda_ ** 2 * future_t ** 3 / 3
+    multiplier = 1 + forecast['multiplicative_terms'].to_numpy()
+    spread = z * model.y_scale * np.sqrt(sigma_obs ** 2 + multiplier ** 2 * trend_variance)
+    yhat = forecast['yhat'].to_numpy()
+    return yhat - spread, yhat + spread
+
+
+def residual_intervals(model, forecast, interval_width=0.95):
+    """Intervalos pelos quantis dos resíduos do ajuste no histórico.
+    
+    `forecast` precisa incluir as datas do histórico (make_future_dataframe
+    já inclui). Retorna (lower, upper).
+    """
+    fitted = forecast[['ds', 'yhat']].merge(model.history[['ds', 'y']], on='ds')
+    residuals = (fitted['y'] - fitted['yhat']).to_numpy()
+    low, high = np.quantile(residuals, [0.5 - interval_width / 2, 0.5 + interval_width / 2])
+    yhat = forecast['yhat'].to_numpy()
+    return yhat + low, yhat + high
+
+
+class CatalogETS:
+    """Suavização exponencial sazonal para o catálogo inteiro de uma vez.
+    
+    Holt-Winters aditivo com tendência amortecida e sazonalidade semanal,
+    ajustado sobre a matriz ASIN×data. Cada passo de tempo é uma operação
+    de array sobre todas as séries e todas as combinações de parâmetros da
+    grade; no fim, cada série fica com a combinação de menor erro de um
+    passo à frente. O custo cresce com (dias × ASINs), sem um fit por ASIN.
+    """
+    
+    SEASON = 7
+    WARMUP = 14  # Dias ignorados na escolha dos parâmetros
+    ALPHAS = (0.05, 0.2, 0.5)
+    BETAS = (0.01, 0.1)
+    GAMMAS = (0.05, 0.3)
+    PHIS = (0.9, 0.98)
+    
+    def __init__(self, interval_width=0.95):
+        self.z = NormalDist().inv_cdf(0.5 + interval_width / 2)
+        grid = np.array(list(itertools.product(self.ALPHAS, self.BETAS, self.GAMMAS, self.PHIS)))
+        self.grid = grid  # K×4: alpha, beta, gamma, phi
+    
+    def _initial_state(self, Y, start):
+        """Nível, tendência e sazonalidade iniciais a partir das 2 primeiras semanas"""
+        n_series, n_days = Y.shape
+        m = self.SEASON
+        rows = np.arange(n_series)[:, None]
+        cols = np.minimum(start[:, None] + np.arange(2 * m), n_days - 1)
+        window = Y[rows, cols]
+        
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            first_week = np.nanmean(window[:, :m], axis=1)
+            second_week = np.nanmean(window[:, m:], axis=1)
+        level = np.nan_to_num(first_week)
+        trend = np.nan_to_num((second_week - first_week) / m)
+        
+        # Sazonalidade indexada pela posição absoluta (t % m) no calendário
+        season = np.zeros((n_series, m))
+        season[rows, cols[:, :m] % m] = np.nan_to_num(window[:, :m] - level[:, None])
+        season -= season.mean(axis=1, keepdims=True)
+        return level, trend, season
+    
+    def fit_predict(self, Y, horizon, events=None):
+        """Ajusta todas as séries de Y (ASIN×data) e prevê `horizon` dias.
+        
+        NaN em Y marca dias anteriores ao início de cada série; dentro da
+        série, dias sem venda devem vir como 0.
+        
+        `events` é a matriz booleana (dias do histórico + horizonte) × evento
+        do calendário compartilhado. Dias de evento não atualizam o estado nem
+        entram na escolha dos parâmetros; o erro nesses dias estima o efeito
+        de cada evento por série, somado à previsão nos eventos futuros.
+        """
+        n_series, n_days = Y.shape
+        m = self.SEASON
+        if events is None:
+            events = np.zeros((n_days + horizon, 0), dtype=bool)
+        n_events = events.shape[1]
+        observed = ~np.isnan(Y)
+        start = np.where(observed.any(axis=1), observed.argmax(axis=1), n_days - 1)
+        
+        alpha, beta, gamma, phi = (self.grid[:, i][:, None] for i in range(4))  # K×1
+        n_params = len(self.grid)
+        
+        level0, trend0, season0 = self._initial_state(Y, start)
+        level = np.repeat(level0[None, :], n_params, axis=0)       # K×N
+        trend = np.repeat(trend0[None, :], n_params, axis=0)       # K×N
+        season = np.repeat(season0[None, :, :], n_params, axis=0)  # K×N×m
+        
+        sse = np.zeros((n_params, n_series))
+        ape = np.zeros((n_params, n_series))
+        n_errors = np.zeros(n_series)
+        n_ape = np.zeros(n_series)
+        event_sum = np.zeros((n_params, n_series, n_events))
+        event_count = np.zeros((n_series, n_events))
+        
+        for t in range(n_days):
+            y = Y[:, t]
+            obs = observed[:, t]
+            s = season[:, :, t % m]
+            damped = phi * trend
+            error = np.where(obs, y - (level + damped + s), 0.0)
+            
+            active = events[t]
+            if active.any():
+                # Erro do dia dividido entre os eventos ativos; estado só avança
+                event_sum += error[:, :, None] * (active / active.sum())
+                event_count += obs[:, None] * active
+                level = np.where(obs, level + damped, level)
+                trend = np.where(obs, damped, trend)
+                continue
+                
+            # Erros de um passo à frente, depois do aquecimento
+            scored = obs & (t >= start + self.WARMUP)
+            positive = scored & (y > 0)
+            sse += np.where(scored, error ** 2, 0.0)
+            ape += np.where(positive, np.abs(error) / np.where(positive, y, 1.0), 0.0)
+            n_errors += scored
+            n_ape += positive
+            
+            # Atualização só onde a série já começou
+            new_level = level + damped + alpha * error
+            new_trend = damped + alpha * beta * error
+            new_season = s + gamma * (1 - alpha) * error
+            level = np.where(obs, new_level, level)
+            trend = np.where(obs, new_trend, trend)
+            season[:, :, t % m] = np.where(obs, new_season, s)
+            
+        # Melhor combinação de parâmetros por série
+        best = sse.argmin(axis=0)
+        cols = np.arange(n_series)
+        level, trend, season = level[best, cols], trend[best, cols], season[best, cols]
+        event_effect = event_sum[best, cols] / (event_count + 1)  # Encolhido para poucos eventos
+        alpha, beta, gamma, phi = (self.grid[best, i][:, None] for i in range(4))  # N×1
+        sigma2 = sse[best, cols] / np.maximum(n_errors - 1, 1)
+        
+        steps = np.arange(1, horizon + 1)
+        phi_sum = np.cumsum(phi ** steps, axis=1)                    # N×H
+        trend_component = level[:, None] + phi_sum * trend[:, None]
+        season_component = season[:, (n_days + steps - 1) % m]
+        event_component = event_effect @ events[n_days:n_days + horizon].T.astype(float)
+        yhat = trend_component + season_component + event_component
+        
+        # Variância do ETS(A,Ad,A) h passos à frente
+        c = alpha * (1 + beta * phi_sum) + gamma * (1 - alpha) * (steps % m == 0)
+        c2 = np.concatenate([np.zeros((n_series, 1)), np.cumsum(c[:, :-1] ** 2, axis=1)], axis=1)
+        spread = self.z * np.sqrt(sigma2[:, None] * (1 + c2))
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mape = np.where(n_ape > 0, ape[best, cols] / n_ape, np.nan)
+            
+        return {
+            'yhat': yhat,
+            'yhat_lower': yhat - spread,
+            'yhat_upper': yhat + spread,
+            'trend': trend_component,
+            'weekly': season_component,
+            'holidays': event_component,
+            'mape': mape,
+            'params': self.grid[best]
+        }
+
+
+class CatalogGBM:
+    """Modelo global de gradient boosting (LightGBM) para o catálogo inteiro.
+    
+    Um único modelo é treinado com as linhas (ASIN, dia) de todas as séries,
+    com lags, médias móveis, calendário, eventos e preço como features. As
+    vendas são normalizadas pelo nível médio de cada série, então ASINs de
+    volumes diferentes compartilham os mesmos padrões. A previsão é
+    recursiva: cada dia do horizonte é uma chamada de predict para todos os
+    ASINs. O custo cresce com o total de linhas, não com o número de ASINs.
+    """
+    
+    LAGS = (1, 2, 3, 7, 14, 28)
+    WINDOWS = (7, 28)
+    MIN_HISTORY = 7      # Dias desde o início da série para virar linha de treino
+    VALIDATION_DAYS = 14  # Últimos dias usados para early stopping e intervalos
+    PARAMS = {
+        'objective': 'regression',
+        'learning_rate': 0.05,
+        'num_leaves': 31,
+        'min_data_in_leaf': 50,
+        'feature_fraction': 0.9,
+        'bagging_fraction': 0.8,
+        'bagging_freq': 1,
+        'seed': 42,
+        'verbose': -1
+    }
+    MAX_ROUNDS = 500
+    
+    def __init__(self, interval_width=0.95):
+        self.quantiles = (0.5 - interval_width / 2, 0.5 + interval_width / 2)
+    
+    def _features(self, Z, cols, static):
+        """Matriz de features (N × len(cols) × F) para os dias `cols` de Z.
+        
+        Z é a série normalizada (NaN antes do início e nos dias a prever);
+        lags e janelas usam só dias anteriores a cada coluna.
+        """
+        n_series = Z.shape[0]
+        observed = ~np.isnan(Z)
+        filled = np.where(observed, Z, 0.0)
+        zeros = np.zeros((n_series, 1))
+        sums = np.concatenate([zeros, np.cumsum(filled, axis=1)], axis=1)
+        squares = np.concatenate([zeros, np.cumsum(filled ** 2, axis=1)], axis=1)
+        counts = np.concatenate([zeros, np.cumsum(observed, axis=1)], axis=1)
+        
+        features = []
+        for lag in self.LAGS:
+            source = cols - lag
+            lagged = Z[:, np.maximum(source, 0)]
+            features.append(np.where(source >= 0, lagged, np.nan))
+            
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for window in self.WINDOWS:
+                begin = np.maximum(cols - window, 0)
+                count = counts[:, cols] - counts[:, begin]
+                mean = (sums[:, cols] - sums[:, begin]) / count
+                features.append(mean)
+                if window == self.WINDOWS[0]:
+                    variance = (squares[:, cols] - squares[:, begin]) / count - mean ** 2
+                    features.append(np.sqrt(np.maximum(variance, 0.0)))
+                    
+        # Features que não dependem das vendas: calendário, eventos, preço, nível
+        for values in static:
+            values = values[cols] if values.ndim == 1 else values[:, cols]
+            features.append(np.broadcast_to(values, (n_series, len(cols))))
+            
+        return np.stack(features, axis=-1)
+    
+    def _static_features(self, dates, events, prices, scale):
+        """Features conhecidas de antemão para histórico + horizonte"""
+        static = [
+            dates.dayofweek.to_numpy(dtype=float),
+            dates.day.to_numpy(dtype=float),
+            dates.month.to_numpy(dtype=float)
+        ]
+        static.extend(events[:, e].astype(float) for e in range(events.shape[1]))
+        
+        # Preço do dia relativo à média dos 28 dias anteriores; no horizonte
+        # fica o último preço conhecido
+        prices = pd.DataFrame(prices).ffill(axis=1).bfill(axis=1).to_numpy()
+        reference = pd.DataFrame(prices.T).rolling(28, min_periods=1).mean().shift(1).to_numpy().T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            static.append(prices / reference)
+        static.append(np.log1p(prices))
+        static.append(np.repeat(np.log1p(scale)[:, None], len(dates), axis=1))
+        return static
+    
+    def _predict_recursive(self, booster, Z, first, horizon, static):
+        """Preenche Z[:, first:first + horizon] dia a dia com as previsões"""
+        Z = Z.copy()
+        Z[:, first:first + horizon] = np.nan
+        for t in range(first, first + horizon):
+            X = self._features(Z, np.array([t]), static)[:, 0, :]
+            Z[:, t] = np.maximum(booster.predict(X), 0.0)
+        return Z[:, first:first + horizon]
+    
+    def fit_predict(self, Y, horizon, dates, prices, events=None):
+        """Treina o modelo global sobre Y (ASIN×data) e prevê `horizon` dias.
+        
+        `dates` cobre histórico + horizonte, `prices` é a matriz ASIN×data de
+        preço médio diário (NaN sem venda) e `events` a matriz booleana de
+        eventos do calendário nas mesmas datas. NaN em Y marca dias
+        anteriores ao início de cada série.
+        
+        Os intervalos vêm dos quantis dos erros da previsão recursiva nos
+        últimos VALIDATION_DAYS, com o modelo treinado sem esses dias.
+        """
+        n_series, n_days = Y.shape
+        if events is None:
+            events = np.zeros((n_days + horizon, 0), dtype=bool)
+        observed = ~np.isnan(Y)
+        start = np.where(observed.any(axis=1), observed.argmax(axis=1), n_days - 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            scale = np.maximum(np.nan_to_num(np.nanmean(Y, axis=1)), 1.0)
+            
+        padding = np.full((n_series, horizon), np.nan)
+        prices = np.concatenate([prices, padding], axis=1)
+        Z = np.concatenate([Y / scale[:, None], padding], axis=1)
+        static = self._static_features(dates, events, prices, scale)
+        
+        cols = np.arange(n_days)
+        X = self._features(Z, cols, static)
+        trainable = observed & (cols >= start[:, None] + self.MIN_HISTORY)
+        validation_start = max(n_days - self.VALIDATION_DAYS, 1)
+        is_validation = cols >= validation_start
+        train_rows = trainable & ~is_validation
+        valid_rows = trainable & is_validation
+        
+        train_set = lgb.Dataset(X[train_rows], Z[:, :n_days][train_rows], free_raw_data=False)
+        valid_set = lgb.Dataset(X[valid_rows], Z[:, :n_days][valid_rows], reference=train_set)
+        booster = lgb.train(
+            self.PARAMS, train_set, num_boost_round=self.MAX_ROUNDS,
+            valid_sets=[valid_set], callbacks=[lgb.early_stopping(20, verbose=False)]
+        )
+        rounds = booster.best_iteration or self.MAX_ROUNDS
+        
+        # Erros de vários passos à frente na validação, em unidades normalizadas
+        backtest = self._predict_recursive(
+            booster, Z, validation_start, n_days - validation_start, static
+        )
+        actual = Z[:, validation_start:n_days]
+        scored = valid_rows[:, validation_start:]
+        residuals = (actual - backtest)[scored]
+        if len(residuals):
+            low, high = np.quantile(residuals, self.quantiles)
+        else:
+            low, high = 0.0, 0.0
+        positive = scored & (actual > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ape = np.where(positive, np.abs(actual - backtest) / np.where(positive, actual, 1.0), 0.0)
+            mape = np.where(positive.any(axis=1), ape.sum(axis=1) / positive.sum(axis=1), np.nan)
+            
+        # Modelo final com todos os dias e o número de rodadas da validação
+        booster = lgb.train(
+            self.PARAMS, lgb.Dataset(X[trainable], Z[:, :n_days][trainable]),
+            num_boost_round=rounds
+        )
+        forecast = self._predict_recursive(booster, Z, n_days, horizon, static)
+        yhat = forecast * scale[:, None]
+        zeros = np.zeros_like(yhat)
+        
+        return {
+            'yhat': yhat,
+            'yhat_lower': yhat + low * scale[:, None],
+            'yhat_upper': yhat + high * scale[:, None],
+            'trend': yhat,  # Sem decomposição em componentes
+            'weekly': zeros,
+            'holidays': zeros,
+            'mape': mape,
+            'rounds': rounds
+        }
+
+
+class ForecastWriter:
+    """Grava previsões direto em demand_forecasts, sem passar pelo Node.
+    
+    As linhas diárias são acumuladas em CSV num arquivo temporário (em
+    memória até `max_memory_bytes`, depois em disco). No commit, um único
+    COPY carrega tudo numa tabela temporária e um INSERT ... SELECT ...
+    ON CONFLICT faz o upsert na mesma transação; a conexão só é aberta no fim.
+    """
+    
+    COLUMNS = (
+        'asin', 'forecast_date', 'tenant_id',
+        'units_forecast', 'units_lower_bound', 'units_upper_bound',
+        'revenue_forecast', 'revenue_lower_bound', 'revenue_upper_bound',
+        'seasonality_factor', 'trend_factor', 'promotion_factor',
+        'recommended_stock_level', 'reorder_point', 'reorder_quantity',
+        'model_name', 'model_version', 'confidence_level', 'mape'
+    )
+    
+    # Fatores são DECIMAL(3,2) e mape DECIMAL(5,2): valores fora da faixa
+    # são limitados para uma linha ruim não derrubar o lote inteiro
+    MERGE_QUERY = """
+    INSERT INTO demand_forecasts ({columns})
+    SELECT
+        asin, forecast_date, tenant_id,
+        units_forecast, units_lower_bound, units_upper_bound,
+        revenue_forecast, revenue_lower_bound, revenue_upper_bound,
+        LEAST(GREATEST(seasonality_factor, -9.99), 9.99),
+        LEAST(GREATEST(trend_factor, -9.99), 9.99),
+        LEAST(GREATEST(promotion_factor, -9.99), 9.99),
+        recommended_stock_level, reorder_point, reorder_quantity,
+        model_name, model_version, confidence_level,
+        LEAST(mape, 999.99)
+    FROM forecast_staging
+    ON CONFLICT (asin, forecast_date) DO UPDATE SET
+        tenant_id = EXCLUDED.tenant_id,
+        units_forecast = EXCLUDED.units_forecast,
+        units_lower_bound = EXCLUDED.units_lower_bound,
+        units_upper_bound = EXCLUDED.units_upper_bound,
+        revenue_forecast = EXCLUDED.revenue_forecast,
+        revenue_lower_bound = EXCLUDED.revenue_lower_bound,
+        revenue_upper_bound = EXCLUDED.revenue_upper_bound,
+        seasonality_factor = EXCLUDED.seasonality_factor,
+        trend_factor = EXCLUDED.trend_factor,
+        promotion_factor = EXCLUDED.promotion_factor,
+        recommended_stock_level = EXCLUDED.recommended_stock_level,
+        reorder_point = EXCLUDED.reorder_point,
+        reorder_quantity = EXCLUDED.reorder_quantity,
+        model_name = EXCLUDED.model_name,
+        model_version = EXCLUDED.model_version,
+        confidence_level = EXCLUDED.confidence_level,
+        mape = EXCLUDED.mape
+    """
+    
+    STAGING_TABLE = """
+    CREATE TEMP TABLE forecast_staging (
+        asin VARCHAR(10),
+        forecast_date DATE,
+        tenant_id VARCHAR(50),
+        units_forecast INTEGER,
+        units_lower_bound INTEGER,
+        units_upper_bound INTEGER,
+        revenue_forecast DOUBLE PRECISION,
+        revenue_lower_bound DOUBLE PRECISION,
+        revenue_upper_bound DOUBLE PRECISION,
+        seasonality_factor DOUBLE PRECISION,
+        trend_factor DOUBLE PRECISION,
+        promotion_factor DOUBLE PRECISION,
+        recommended_stock_level INTEGER,
+        reorder_point INTEGER,
+        reorder_quantity INTEGER,
+        model_name VARCHAR(50),
+        model_version VARCHAR(20),
+        confidence_level DOUBLE PRECISION,
+        mape DOUBLE PRECISION
+    ) ON COMMIT DROP
+    """
+    
+    def __init__(self, max_memory_bytes=16 * 1024 * 1024):
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes, mode='w+', newline='')
+        self.writer = csv.writer(self.buffer)
+        self.forecasts = 0
+        self.rows = 0
+    
+    @staticmethod
+    def daily_rows(daily_forecasts):
+        """Linhas diárias de uma previsão em qualquer um dos dois formatos"""
+        if isinstance(daily_forecasts, list):
+            return daily_forecasts
+        fields = list(daily_forecasts)
+        return [dict(zip(fields, values)) for values in zip(*daily_forecasts.values())]
+    
+    def add(self, forecast):
+        """Acumula as linhas diárias de uma previsão para o COPY"""
+        for daily in self.daily_rows(forecast['daily_forecasts']):
+            self.writer.writerow([
+                forecast['asin'], daily['date'], forecast.get('tenant_id', 'default'),
+                daily['units_forecast'], daily['units_lower'], daily['units_upper'],
+                daily['revenue_forecast'], daily['revenue_lower'], daily['revenue_upper'],
+                daily['seasonality_factor'], daily['trend_factor'], daily.get('promotion_factor', 1.0),
+                forecast['recommended_stock_level'], forecast['reorder_point'],
+                forecast['reorder_quantity'],
+                forecast['model_name'], forecast['model_version'], forecast['confidence_level'],
+                forecast['mape']  # None vira campo vazio = NULL no CSV
+            ])
+            self.rows += 1
+        self.forecasts += 1
+    
+    def commit(self, conn, mape_updates=None):
+        """Carrega as linhas e faz o upsert em demand_forecasts.
+        
+        `mape_updates` (ASIN -> MAPE) aplica MAPEs calculados depois que as
+        previsões foram acumuladas. Retorna o número de linhas gravadas.
+        """
+        self.buffer.seek(0)
+        with conn.cursor() as cursor:
+            cursor.execute(self.STAGING_TABLE)
+            cursor.copy_expert(
+                f"COPY forecast_staging ({', '.join(self.COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                self.buffer
+            )
+            if mape_updates:
+                cursor.execute("""
+                UPDATE forecast_staging s
+                SET mape = u.mape
+                FROM unnest(%s::text[], %s::double precision[]) AS u(asin, mape)
+                WHERE s.asin = u.asin
+                """, (list(mape_updates), list(mape_updates.values())))
+            cursor.execute(self.MERGE_QUERY.format(columns=', '.join(self.COLUMNS)))
+            upserted = cursor.rowcount
+        conn.commit()
+        self.buffer.close()
+        return upserted
+
+
 class DemandForecaster:
     def __init__(self):
         self.db_config = {
@@ -29,6 +923,39 @@ class DemandForecaster:
             'user': os.getenv('DB_USER', 'postgres'),
             'password': os.getenv('DB_PASSWORD')
         }
+        self.model_cache = None
+        self.output_format = 'rows'
+        self.asin_budget = None
+        self.interval_mode = 'sampled'
+        years = event_calendar_years()
+        self.event_calendar = get_event_calendar(years, use_disk=False)
+        self.model_key = model_config_key(calendar_key=event_calendar_key(years))
+        
+    def configure(self, params):
+        """Aplica opções da execução que valem para todas as previsões"""
+        self.output_format = params.get('output_format', 'rows')
+        # Segundos por ASIN para fit + predict (e para a validação cruzada)
+        self.asin_budget = float(params.get('asin_budget_seconds') or 0) or None
+        self.interval_mode = params.get('interval_mode', 'sampled')
+        
+        # Calendário de eventos compartilhado por todos os fits
+        if params.get('include_holidays', True):
+            years = event_calendar_years()
+            self.event_calendar = get_event_calendar(years, params.get('event_calendar_disk_cache', True))
+            self.model_key = model_config_key(calendar_key=event_calendar_key(years))
+        else:
+            self.event_calendar = None
+            self.model_key = model_config_key()
+        
+        if params.get('model_cache', True):
+            max_mb = params.get(
+                'model_cache_max_mb', int(os.getenv('FORECAST_MODEL_CACHE_MAX_MB', '512'))
+            )
+            self.model_cache = ProphetModelCache(
+                max_bytes=max_mb * 1024 * 1024, model_key=self.model_key
+            )
+        else:
+            self.model_cache = None
         
     def get_connection(self):
         """Conecta ao PostgreSQL"""
@@ -80,178 +1007,1039 @@ class DemandForecaster:
                 cursor.execute(query, (asin,))
                 return cursor.fetchone()
     
-    def add_brazilian_holidays(self, model):
-        """Adiciona feriados brasileiros ao modelo"""
-        # Feriados fixos
-        model.add_country_holidays(country_name='BR')
-        
-        # Datas especiais de e-commerce
-        for year in range(2022, 2026):
-            # Black Friday (última sexta de novembro)
-            black_friday = pd.Timestamp(year=year, month=11, day=1) + pd.DateOffset(weeks=3, weekday=4)
-            model.add_seasonality(
-                name='black_friday',
-                period=365.25,
-                fourier_order=5,
-                condition_name='is_black_friday'
-            )
-            
-            # Cyber Monday
-            cyber_monday = black_friday + pd.DateOffset(days=3)
+    def load_forecast_inputs(self, asins, days=180):
+        """Carrega histórico e informações de todos os ASINs em lote.
+        
+        Usa uma única conexão e duas consultas (vendas e produtos) em vez de
+        duas conexões por ASIN. Retorna (histories, product_infos), ambos
+        indexados por ASIN, com cada histórico já no formato de
+        get_historical_data.
+        """
+        if not asins:
+            return {}, {}
             
-            # Prime Day (geralmente em julho)
-            prime_day = pd.Timestamp(year=year, month=7, day=15)
+        history_query = """
+        SELECT 
+            asin,
+            date as ds,
+            units_ordered as y,
+            ordered_product_sales as revenue,
+            EXTRACT(DOW FROM date) as day_of_week,
+            EXTRACT(MONTH FROM date) as month,
+            CASE 
+                WHEN EXTRACT(DOW FROM date) IN (0, 6) THEN 1 
+                ELSE 0 
+            END as is_weekend
+        FROM sales_metrics
+        WHERE asin = ANY(%s)
+        AND date >= CURRENT_DATE - INTERVAL '%s days'
+        AND date < CURRENT_DATE
+        ORDER BY asin, date
+        """
+        
+        info_query = """
+        SELECT 
+            p.asin,
+            p.name,
+            p.price,
+            p.lead_time_days,
+            p.min_order_quantity,
+            AVG(i.fulfillable_quantity) as avg_inventory
+        FROM products p
+        LEFT JOIN inventory_snapshots i ON p.asin = i.asin
+        WHERE p.asin = ANY(%s)
+        GROUP BY p.asin, p.name, p.price, p.lead_time_days, p.min_order_quantity
+        """
+        
+        asins = list(asins)
+        with self.get_connection() as conn:
+            history = pd.read_sql(history_query, conn, params=(asins, days))
+            with conn.cursor() as cursor:
+                cursor.execute(info_query, (asins,))
+                product_infos = {row['asin']: dict(row) for row in cursor.fetchall()}
+                
+        # Fatiar em memória: um DataFrame por ASIN
+        histories = {
+            asin: group.drop(columns='asin').reset_index(drop=True)
+            for asin, group in history.groupby('asin', sort=False)
+        }
+        
+        return histories, product_infos
+    
+    def _prepare_history(self, df):
+        """Ajusta o histórico para o formato de treino do Prophet"""
+        df = df.copy()
+        df['ds'] = pd.to_datetime(df['ds'])
+        df['cap'] = df['y'].max() * 2  # Cap para logistic growth
+        df['floor'] = 0
+        return df
+    
+    def _build_model(self, df):
+        """Cria o modelo Prophet (ainda não treinado)"""
+        # Feriados e datas especiais vêm do calendário compartilhado
+        model = Prophet(holidays=self.event_calendar, **PROPHET_CONFIG)
+        
+        # Adicionar regressores se disponíveis
+        if 'is_weekend' in df.columns:
+            model.add_regressor('is_weekend')
             
         return model
     
-    def forecast_demand(self, asin, forecast_days=30):
-        """Gera previsão de demanda para um produto"""
+    def forecast_demand(self, asin, forecast_days=30, history=None, product_info=None):
+        """Gera previsão de demanda para um produto
+        
+        `history` e `product_info` podem vir pré-carregados por
+        load_forecast_inputs; caso contrário são buscados no banco.
+        """
         # Buscar dados históricos
-        df = self.get_historical_data(asin)
+        df = self.get_historical_data(asin) if history is None else history.copy()
         
         if len(df) < 30:  # Mínimo 30 dias de dados
             return None
             
         # Buscar informações do produto
-        product_info = self.get_product_info(asin)
+        if product_info is None:
+            product_info = self.get_product_info(asin)
         
         # Preparar dados para Prophet
-        df['cap'] = df['y'].max() * 2  # Cap para logistic growth
-        df['floor'] = 0
-        
-        # Criar modelo
-        model = Prophet(
-            growth='linear',  # ou 'logistic' se houver saturação
-            changepoint_prior_scale=0.05,
-            seasonality_mode='multiplicative',
-            yearly_seasonality=True,
-            weekly_seasonality=True,
-            daily_seasonality=False,
-            interval_width=0.95
-        )
-        
-        # Adicionar feriados
-        model = self.add_brazilian_holidays(model)
+        df = self._prepare_history(df)
         
-        # Adicionar regressores se disponíveis
-        if 'is_weekend' in df.columns:
-            model.add_regressor('is_weekend')
+        # Reaproveitar modelo em cache quando a série não mudou
+        cache_status, cached_model = 'disabled', None
+        if self.model_cache:
+            cache_status, cached_model = self.model_cache.lookup(asin, df)
+            
+        started = time.monotonic()
+        try:
+            if cache_status == 'hit':
+                model = cached_model
+            else:
+                model = self._build_model(df)
+                
+                # Treinar modelo (warm start a partir do modelo anterior, se houver)
+                if cache_status == 'warm':
+                    try:
+                        self._fit(model, df, init=warm_start_params(cached_model))
+                    except ForecastTimeout:
+                        raise
+                    except Exception:
+                        # Warm start ruim não derruba o ASIN: treino do zero
+                        cache_status = 'cold'
+                        model = self._build_model(df)
+                        self._fit(model, df)
+                else:
+                    self._fit(model, df)
+            
+            # O resto do orçamento vale para a previsão (só Python, sem processo do Stan)
+            with time_budget(self._remaining_budget(started)):
+                # Criar dataframe futuro
+                future = model.make_future_dataframe(periods=forecast_days)
+                future['cap'] = df['cap'].max()
+                future['floor'] = 0
+                
+                # Adicionar regressores ao futuro
+                future['is_weekend'] = (future['ds'].dt.dayofweek >= 5).astype(int)
+                
+                # Fazer previsão
+                forecast = self._predict(model, future)
+        except ForecastTimeout:
+            # Série patológica: previsão ingênua barata, sinalizada no resultado
+            result = self._build_forecast_result(
+                asin, product_info, self._baseline_forecast(df, forecast_days), None, 'stable',
+                model_name='baseline'
+            )
+            result['model_cache'] = cache_status
+            result['fallback'] = {'reason': 'asin_budget_exceeded', 'budget_seconds': self.asin_budget}
+            return result
             
-        # Treinar modelo
-        model.fit(df)
+        if self.model_cache and cache_status != 'hit':
+            self.model_cache.store(asin, df, model)
+        
+        # O MAPE é calculado depois, na etapa evaluate_accuracy
+        mape = None
         
-        # Criar dataframe futuro
-        future = model.make_future_dataframe(periods=forecast_days)
-        future['cap'] = df['cap'].max()
-        future['floor'] = 0
+        # Preparar resultado
+        future_forecast = forecast[forecast['ds'] > df['ds'].max()].copy()
+        growth_trend = 'increasing' if forecast['trend'].iloc[-1] > forecast['trend'].iloc[-30] else 'stable'
         
-        # Adicionar regressores ao futuro
-        future['is_weekend'] = (future['ds'].dt.dayofweek >= 5).astype(int)
+        result = self._build_forecast_result(asin, product_info, future_forecast, mape, growth_trend)
+        result['model_cache'] = cache_status
+        return result
+    
+    def _predict(self, model, future, interval_mode=None):
+        """predict do Prophet com os intervalos do modo configurado.
         
-        # Fazer previsão
+        Fora do modo 'sampled' o predict não amostra trajetórias
+        (uncertainty_samples = 0) e yhat_lower/yhat_upper são calculados
+        depois, por analytic_intervals ou residual_intervals.
+        """
+        interval_mode = interval_mode or self.interval_mode
+        # Definido sempre: o modelo pode ter vindo do cache com outro valor
+        model.uncertainty_samples = UNCERTAINTY_SAMPLES if interval_mode == 'sampled' else 0
         forecast = model.predict(future)
+        if interval_mode == 'analytic':
+            forecast['yhat_lower'], forecast['yhat_upper'] = analytic_intervals(model, forecast)
+        elif interval_mode == 'residual':
+            forecast['yhat_lower'], forecast['yhat_upper'] = residual_intervals(model, forecast)
+        return forecast
+    
+    def _baseline_forecast(self, df, forecast_days, interval_width=0.95):
+        """Previsão ingênua sazonal: média por dia da semana das últimas 4
+        semanas, com intervalo pelo desvio dos resíduos nessas semanas"""
+        daily = df.groupby('ds')['y'].sum()
+        daily = daily.reindex(pd.date_range(daily.index.min(), daily.index.max(), freq='D'), fill_value=0)
+        recent = daily.iloc[-28:].astype(float)
+        by_weekday = recent.groupby(recent.index.dayofweek).mean()
+        residuals = recent.to_numpy() - by_weekday.reindex(recent.index.dayofweek).to_numpy()
+        spread = NormalDist().inv_cdf(0.5 + interval_width / 2) * (residuals.std() if len(residuals) > 1 else 0.0)
         
-        # Calcular métricas de erro (se possível)
-        mape = None
-        if len(df) > 60:  # Precisa de dados suficientes para validação
-            try:
-                df_cv = cross_validation(model, initial='30 days', period='10 days', horizon='10 days')
-                df_p = performance_metrics(df_cv)
-                mape = df_p['mape'].mean()
-            except:
-                mape = None
-                
-        # Preparar resultado
-        future_forecast = forecast[forecast['ds'] > df['ds'].max()].copy()
+        future_dates = pd.date_range(daily.index.max() + timedelta(days=1), periods=forecast_days, freq='D')
+        yhat = by_weekday.reindex(future_dates.dayofweek).fillna(recent.mean()).to_numpy()
+        level = np.full(forecast_days, recent.mean())
+        return {
+            'ds': future_dates,
+            'yhat': yhat,
+            'yhat_lower': yhat - spread,
+            'yhat_upper': yhat + spread,
+            'trend': level,
+            'weekly': yhat - level
+        }
+    
+    def _build_forecast_result(self, asin, product_info, future_forecast, mape, growth_trend,
+                               model_name='prophet'):
+        """Monta o resultado no formato esperado por saveDemandForecast.
+        
+        `future_forecast` segue as colunas do predict do Prophet (ds, yhat,
+        yhat_lower, yhat_upper, trend, yearly, weekly) e contém só os dias
+        futuros; pode ser um DataFrame ou um dict de arrays. Todos os motores
+        de previsão passam por aqui.
+        
+        As previsões diárias são calculadas coluna a coluna. Com
+        output_format='columnar' saem como listas paralelas por campo; no
+        padrão ('rows') viram a lista de dicts por dia.
+        """
+        yhat = np.asarray(future_forecast['yhat'], dtype=float)
+        yhat_lower = np.asarray(future_forecast['yhat_lower'], dtype=float)
+        yhat_upper = np.asarray(future_forecast['yhat_upper'], dtype=float)
+        
+        def component(name, default):
+            if name in future_forecast:
+                return np.asarray(future_forecast[name], dtype=float)
+            return np.full(len(yhat), default)
         
         # Calcular recomendações de estoque
-        avg_daily_forecast = future_forecast['yhat'].mean()
+        avg_daily_forecast = float(yhat.mean())
         lead_time = product_info['lead_time_days'] or 21
-        safety_stock_days = 7 + future_forecast['yhat'].std() / avg_daily_forecast * 2
+        safety_stock_days = 7 + yhat.std(ddof=1) / avg_daily_forecast * 2
         
         reorder_point = int(avg_daily_forecast * (lead_time + safety_stock_days))
         reorder_quantity = int(avg_daily_forecast * 30)  # 30 dias de estoque
         recommended_stock = int(avg_daily_forecast * (lead_time + safety_stock_days + 30))
         
-        # Preparar dados diários
-        daily_forecasts = []
-        for _, row in future_forecast.iterrows():
-            daily_forecasts.append({
-                'date': row['ds'].strftime('%Y-%m-%d'),
-                'units_forecast': max(0, int(row['yhat'])),
-                'units_lower': max(0, int(row['yhat_lower'])),
-                'units_upper': max(0, int(row['yhat_upper'])),
-                'revenue_forecast': max(0, row['yhat'] * (product_info['price'] or 0)),
-                'revenue_lower': max(0, row['yhat_lower'] * (product_info['price'] or 0)),
-                'revenue_upper': max(0, row['yhat_upper'] * (product_info['price'] or 0)),
-                'trend_factor': row.get('trend', 1.0) / row['yhat'] if row['yhat'] > 0 else 1.0,
-                'seasonality_factor': (row.get('yearly', 0) + row.get('weekly', 0)) / row['yhat'] if row['yhat'] > 0 else 1.0,
-                'promotion_factor': 1.0  # Placeholder
-            })
+        # Preparar dados diários (vetorizado)
+        price = float(product_info['price'] or 0)
+        positive = yhat > 0
+        safe_yhat = np.where(positive, yhat, 1.0)
+        units = np.maximum(0, np.trunc(yhat)).astype(int)
+        revenue = np.maximum(0, yhat * price)
+        
+        daily = {
+            'date': pd.DatetimeIndex(future_forecast['ds']).strftime('%Y-%m-%d').tolist(),
+            'units_forecast': units.tolist(),
+            'units_lower': np.maximum(0, np.trunc(yhat_lower)).astype(int).tolist(),
+            'units_upper': np.maximum(0, np.trunc(yhat_upper)).astype(int).tolist(),
+            'revenue_forecast': revenue.tolist(),
+            'revenue_lower': np.maximum(0, yhat_lower * price).tolist(),
+            'revenue_upper': np.maximum(0, yhat_upper * price).tolist(),
+            'trend_factor': np.where(positive, component('trend', 1.0) / safe_yhat, 1.0).tolist(),
+            'seasonality_factor': np.where(
+                positive, (component('yearly', 0.0) + component('weekly', 0.0)) / safe_yhat, 1.0
+            ).tolist(),
+            'promotion_factor': [1.0] * len(yhat)  # Placeholder
+        }
+        
+        if self.output_format == 'columnar':
+            daily_forecasts = daily
+        else:
+            fields = list(daily)
+            daily_forecasts = [dict(zip(fields, values)) for values in zip(*daily.values())]
             
         return {
             'asin': asin,
             'product_name': product_info['name'],
-            'model_version': '3.0',
+            'model_name': model_name,
+            'model_version': MODEL_VERSION,
             'confidence_level': 0.95,
             'mape': mape,
             'recommended_stock_level': recommended_stock,
             'reorder_point': reorder_point,
             'reorder_quantity': reorder_quantity,
+            'daily_format': self.output_format,
             'daily_forecasts': daily_forecasts,
             'summary': {
-                'total_units_30d': sum(d['units_forecast'] for d in daily_forecasts),
-                'total_revenue_30d': sum(d['revenue_forecast'] for d in daily_forecasts),
+                'total_units_30d': int(units.sum()),
+                'total_revenue_30d': float(revenue.sum()),
                 'avg_daily_units': avg_daily_forecast,
-                'growth_trend': 'increasing' if forecast['trend'].iloc[-1] > forecast['trend'].iloc[-30] else 'stable'
+                'growth_trend': growth_trend
             }
         }
     
-    def forecast_all_products(self, params):
-        """Gera previsões para todos os produtos ativos"""
-        forecast_days = params.get('forecast_days', 30)
+    def get_forecast_candidates(self, limit=None, shard=(0, 1)):
+        """Busca os ASINs ativos elegíveis para previsão
         
-        # Buscar produtos ativos
+        Ordem fixa (por ASIN) para saída determinística. A última data e o
+        checksum da janela de 180 dias identificam se as vendas do ASIN
+        mudaram desde a última previsão. Com `shard` = (índice, total), só
+        retorna os ASINs daquele shard (ver shard_of); `limit` vale por shard.
+        """
+        shard_index, shard_count = shard
+        shard_filter = ""
+        query_params = ()
+        if shard_count > 1:
+            # Primeiros 32 bits do md5 como inteiro, igual a shard_of()
+            shard_filter = """
+        AND mod(('x' || lpad(substr(md5(p.asin), 1, 8), 16, '0'))::bit(64)::bigint, %s) = %s"""
+            query_params = (shard_count, shard_index)
+            
         query = """
-        SELECT DISTINCT p.asin
+        SELECT 
+            p.asin,
+            MAX(sm.date) FILTER (WHERE sm.date >= CURRENT_DATE - 180 AND sm.date < CURRENT_DATE) as last_sales_date,
+            md5(string_agg(
+                sm.date || ':' || sm.hour || ':' || sm.units_ordered || ':' || sm.ordered_product_sales,
+                ',' ORDER BY sm.date, sm.hour
+            ) FILTER (WHERE sm.date >= CURRENT_DATE - 180 AND sm.date < CURRENT_DATE)) as sales_checksum
         FROM products p
         JOIN sales_metrics sm ON p.asin = sm.asin
         WHERE p.active = true
-        AND p.marketplace = 'amazon'
+        AND p.marketplace = 'amazon'{shard_filter}
         GROUP BY p.asin
         HAVING COUNT(DISTINCT sm.date) >= 30
-        LIMIT 100
-        """
+        ORDER BY p.asin
+        """.format(shard_filter=shard_filter)
+        if limit:
+            query += " LIMIT %s"
+            query_params += (int(limit),)
         
         with self.get_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(query)
-                products = cursor.fetchall()
+                cursor.execute(query, query_params)
+                return cursor.fetchall()
+    
+    def forecast_all_products(self, params, on_forecast=None):
+        """Gera previsões para todos os produtos ativos
+        
+        Com `on_forecast`, cada previsão é entregue à função assim que fica
+        pronta e não é acumulada no resultado; o MAPE calculado depois, na
+        etapa de validação cruzada, vem em `mape_updates` (ASIN -> MAPE).
+        
+        Com `persist: true` as previsões são gravadas em demand_forecasts pelo
+        próprio script (ForecastWriter) e só os contadores voltam no resultado.
+        
+        `asin_budget_seconds` limita o tempo de cada ASIN no Prophet; quem
+        passa do limite recebe uma previsão ingênua marcada em `fallback`.
+        `deadline_seconds` limita a execução inteira: ao chegar no prazo, o
+        que já terminou é devolvido e o resto vai para `unprocessed_asins`.
+        """
+        started = time.monotonic()
+        deadline_seconds = params.get('deadline_seconds')
+        deadline = started + float(deadline_seconds) if deadline_seconds else None
+        forecast_days = params.get('forecast_days', 30)
+        workers = max(1, int(params.get('workers') or 1))
+        limit = params.get('limit', 100)  # None ou 0 = sem limite
+        incremental = params.get('incremental', False)
+        engine = params.get('engine', 'prophet')
+        persist = params.get('persist', False)
+        if engine not in ENGINES:
+            return {'success': False, 'error': f'Unknown engine: {engine}'}
+        if params.get('interval_mode', 'sampled') not in INTERVAL_MODES:
+            return {'success': False, 'error': f'Unknown interval_mode: {params["interval_mode"]}'}
+        try:
+            shard = parse_shard(params)
+        except ValueError as e:
+            return {'success': False, 'error': str(e)}
+        self.configure(params)
+        
+        products = self.get_forecast_candidates(limit, shard)
                 
+        # Modo incremental: só reprevê ASINs cujas vendas mudaram
+        watermarks = ForecastWatermarks(
+            shard_state_path('forecast_watermarks.json', shard)
+        ) if incremental else None
+        skipped = []
+        if watermarks:
+            max_staleness_days = params.get('max_staleness_days', 7)
+            pending = []
+            for product in products:
+                if watermarks.is_current(product, forecast_days, max_staleness_days, engine):
+                    skipped.append(product['asin'])
+                else:
+                    pending.append(product)
+        else:
+            pending = list(products)
+            
+        products_by_asin = {product['asin']: product for product in pending}
+        asins = list(products_by_asin)
+        histories, product_infos = self.load_forecast_inputs(asins)
         forecasts = []
         errors = []
+        writer = ForecastWriter() if persist else None
         
-        for product in products:
-            try:
-                forecast = self.forecast_demand(product['asin'], forecast_days)
-                if forecast:
-                    forecasts.append(forecast)
-            except Exception as e:
+        cache_stats = {}
+        
+        if deadline and time.monotonic() >= deadline:
+            results = []
+        elif engine == 'ets':
+            results = self.forecast_batch_ets(asins, forecast_days, histories, product_infos)
+        elif engine == 'lightgbm':
+            results = self.forecast_batch_lightgbm(asins, forecast_days, histories, product_infos)
+        else:
+            results = self._run_forecasts(
+                asins, forecast_days, workers, histories, product_infos, params, deadline
+            )
+            
+        processed = set()
+        fallbacks = []
+        for asin, forecast, error in results:
+            processed.add(asin)
+            if error:
                 errors.append({
-                    'asin': product['asin'],
-                    'error': str(e)
+                    'asin': asin,
+                    'error': error
                 })
+            elif forecast:
+                status = forecast.get('model_cache')
+                if status:
+                    cache_stats[status] = cache_stats.get(status, 0) + 1
+                if forecast.get('fallback'):
+                    fallbacks.append(asin)
+                if writer:
+                    writer.add(forecast)
+                if on_forecast:
+                    on_forecast(forecast)
+                if writer or on_forecast:
+                    # Só o necessário para a etapa de validação cruzada
+                    forecast = {
+                        'asin': forecast['asin'],
+                        'model_name': forecast.get('model_name'),
+                        'mape': forecast.get('mape')
+                    }
+                forecasts.append(forecast)
+                # Previsão ingênua não conta como atual: o ASIN volta na próxima execução
+                if watermarks and asin not in fallbacks:
+                    watermarks.update(products_by_asin[asin], forecast_days, engine)
+                    
+        if self.model_cache:
+            self.model_cache.evict()
+            
+        unprocessed = [asin for asin in asins if asin not in processed]
+        emitted_mape = {forecast['asin']: forecast['mape'] for forecast in forecasts}
+        cv_errors = []
+        accuracy_stats = self.evaluate_accuracy(forecasts, histories, params, deadline, cv_errors)
+        mape_updates = {
+            forecast['asin']: forecast['mape'] for forecast in forecasts
+            if forecast['mape'] is not None and forecast['mape'] != emitted_mape[forecast['asin']]
+        }
+        
+        output = {}
+        if writer:
+            try:
+                with self.get_connection() as conn:
+                    rows = writer.commit(conn, mape_updates)
+            except psycopg2.Error as e:
+                return {'success': False, 'error': f'Failed to persist forecasts: {e}'}
+            output['persisted'] = {'forecasts': writer.forecasts, 'rows': rows}
+        if on_forecast:
+            output['streamed'] = len(forecasts)
+            if not writer:
+                output['mape_updates'] = mape_updates
+        if not writer and not on_forecast:
+            output['forecasts'] = forecasts
+            
+        # Depois da gravação, para uma falha não deixar ASINs marcados como atuais
+        if watermarks:
+            watermarks.save()
                 
         return {
             'success': True,
             'data': {
-                'forecasts': forecasts,
+                **output,
                 'total_products': len(products),
                 'successful_forecasts': len(forecasts),
                 'errors': len(errors),
+                'error_details': errors,
+                'engine': engine,
+                'workers': workers,
+                'model_cache': cache_stats,
+                'cross_validation': accuracy_stats,
+                'cv_error_details': cv_errors,
+                'incremental': bool(incremental),
+                'refreshed': len(asins),
+                'skipped': len(skipped),
+                'skipped_asins': skipped,
+                'shard': {'index': shard[0], 'count': shard[1]},
+                'fallbacks': len(fallbacks),
+                'fallback_asins': fallbacks,
+                'deadline_reached': bool(deadline) and time.monotonic() >= deadline,
+                'unprocessed': len(unprocessed),
+                'unprocessed_asins': unprocessed,
+                'elapsed_seconds': round(time.monotonic() - started, 3),
                 'timestamp': datetime.now().isoformat()
             }
         }
+    
+    def evaluate_accuracy(self, forecasts, histories, params, deadline=None, failures=None):
+        """Etapa de validação cruzada (MAPE) com orçamento, fora do fit.
+        
+        Opções em `params`:
+        - cv_enabled: desliga a etapa (padrão True)
+        - cv_max_cutoffs: máximo de cortes por ASIN (padrão 3)
+        - cv_sample_size: máximo de ASINs reavaliados por execução (padrão todos)
+        - cv_workers: processos para avaliar os cortes em paralelo (padrão 1)
+        
+        MAPEs ficam em cache até a série mudar. ASINs que mudaram mas ficaram
+        fora da amostra mantêm o último MAPE conhecido; os nunca avaliados e
+        os avaliados há mais tempo têm prioridade na amostra. O mesmo vale
+        para os que passam do orçamento por ASIN (`timed_out`) ou ficam para
+        depois do `deadline` (monotonic) da execução. O motivo de cada falha
+        vai para a lista `failures`, quando informada.
+        """
+        stats = {'evaluated': 0, 'reused': 0, 'deferred': 0, 'failed': 0, 'timed_out': 0}
+        if not params.get('cv_enabled', True):
+            return stats
+            
+        max_cutoffs = max(1, int(params.get('cv_max_cutoffs', 3)))
+        sample_size = params.get('cv_sample_size')
+        cv_workers = int(params.get('cv_workers') or 1)
+        accuracy = ForecastAccuracyCache(
+            shard_state_path('forecast_mape.json', parse_shard(params)),
+            model_key=self.model_key
+        )
+        
+        candidates = []
+        for forecast in forecasts:
+            history = histories.get(forecast['asin'])
+            if forecast.get('model_name') != 'prophet' or history is None or len(history) <= 60:
+                continue  # Precisa de dados suficientes para validação
+                
+            df = self._prepare_history(history)
+            fingerprint = ProphetModelCache.fingerprint(df)
+            previous = accuracy.get(forecast['asin'])
+            if accuracy.is_current(forecast['asin'], fingerprint):
+                forecast['mape'] = previous['mape']
+                stats['reused'] += 1
+            else:
+                candidates.append((previous['evaluated_at'] if previous else '', forecast, df, fingerprint))
+                
+        candidates.sort(key=lambda candidate: (candidate[0], candidate[1]['asin']))
+        if sample_size is not None:
+            for _, forecast, _, _ in candidates[int(sample_size):]:
+                previous = accuracy.get(forecast['asin'])
+                forecast['mape'] = previous['mape'] if previous else None
+                stats['deferred'] += 1
+            candidates = candidates[:int(sample_size)]
+            
+        pool = ProcessPoolExecutor(max_workers=cv_workers) if cv_workers > 1 else None
+        try:
+            for _, forecast, df, fingerprint in candidates:
+                previous = accuracy.get(forecast['asin'])
+                if deadline and time.monotonic() >= deadline:
+                    forecast['mape'] = previous['mape'] if previous else None
+                    stats['deferred'] += 1
+                    continue
+                try:
+                    # O orçamento por ASIN vai para cada treino do Stan (modelo e cortes)
+                    model = self._fitted_model(forecast['asin'], df)
+                    mape, cutoffs = self._cross_validate(model, df, max_cutoffs, pool)
+                    accuracy.update(forecast['asin'], fingerprint, mape, cutoffs)
+                    forecast['mape'] = mape
+                    stats['evaluated'] += 1
+                except ForecastTimeout:
+                    forecast['mape'] = previous['mape'] if previous else None
+                    stats['timed_out'] += 1
+                except Exception as e:
+                    stats['failed'] += 1
+                    if failures is not None:
+                        failures.append({'asin': forecast['asin'], 'error': str(e)})
+        finally:
+            if pool:
+                pool.shutdown()
+                
+        accuracy.save()
+        return stats
+    
+    def _fit(self, model, df, **kwargs):
+        """Treina o Prophet dentro do orçamento por ASIN.
+        
+        O limite vai como `timeout` para o cmdstanpy, que mata o processo do
+        Stan ao estourar (SIGALRM interromperia só o Python e deixaria o
+        processo filho órfão). O Prophet guarda o argumento em `fit_kwargs`,
+        então os retreinos da validação cruzada herdam o mesmo limite.
+        """
+        if self.asin_budget:
+            kwargs['timeout'] = self.asin_budget
+        try:
+            return model.fit(df, **kwargs)
+        except TimeoutError as e:
+            raise ForecastTimeout(f'Exceeded time budget of {self.asin_budget}s') from e
+    
+    def _remaining_budget(self, started):
+        """Segundos que restam do orçamento por ASIN (None = sem limite)"""
+        if not self.asin_budget:
+            return None
+        remaining = self.asin_budget - (time.monotonic() - started)
+        if remaining <= 0:
+            raise ForecastTimeout(f'Exceeded time budget of {self.asin_budget}s')
+        return remaining
+    
+    def _fitted_model(self, asin, df):
+        """Modelo treinado para `df`, do cache quando possível"""
+        if self.model_cache:
+            status, model = self.model_cache.lookup(asin, df)
+            if status == 'hit':
+                return model
+                
+        model = self._build_model(df)
+        self._fit(model, df)
+        return model
+    
+    def _cross_validate(self, model, df, max_cutoffs, pool=None, horizon_days=10, period_days=10,
+                        initial_days=30):
+        """MAPE médio em até `max_cutoffs` cortes, os mais recentes primeiro"""
+        first, last = df['ds'].min(), df['ds'].max()
+        cutoffs = []
+        cutoff = last - timedelta(days=horizon_days)
+        while len(cutoffs) < max_cutoffs and cutoff >= first + timedelta(days=initial_days):
+            cutoffs.insert(0, cutoff)
+            cutoff -= timedelta(days=period_days)
+            
+        if not cutoffs:
+            return None, []
+            
+        # Só o MAPE interessa aqui: sem amostragem de intervalos nos cortes
+        model.uncertainty_samples = 0
+        # Retreinos dos cortes com o limite desta execução (o do cache pode ser outro)
+        # e sem o `init` do warm start: ele é do ajuste na série inteira, e
+        # depois do JSON do cache volta como listas, que o Stan não aceita
+        fit_kwargs = dict(getattr(model, 'fit_kwargs', None) or {})
+        fit_kwargs.pop('timeout', None)
+        fit_kwargs.pop('init', None)
+        if self.asin_budget:
+            fit_kwargs['timeout'] = self.asin_budget
+        model.fit_kwargs = fit_kwargs
+        try:
+            df_cv = cross_validation(
+                model, horizon=f'{horizon_days} days', cutoffs=cutoffs,
+                parallel=pool, disable_tqdm=True
+            )
+        except TimeoutError as e:
+            raise ForecastTimeout(f'Exceeded time budget of {self.asin_budget}s') from e
+        df_p = performance_metrics(df_cv)
+        mape = df_p['mape'].mean()
+        return (None if pd.isna(mape) else float(mape)), [c.strftime('%Y-%m-%d') for c in cutoffs]
+    
+    def _history_matrix(self, asins, histories):
+        """Matriz ASIN×data de vendas diárias para os motores de catálogo.
+        
+        Soma diária, 0 nos dias sem venda e NaN antes do início de cada série.
+        Retorna (dates, Y, prices), com o preço médio diário (receita/unidades)
+        na mesma grade, NaN nos dias sem venda.
+        """
+        frame = pd.concat(
+            [histories[asin][['ds', 'y', 'revenue']].assign(asin=asin) for asin in asins],
+            ignore_index=True
+        )
+        frame['ds'] = pd.to_datetime(frame['ds'])
+        frame['y'] = frame['y'].astype(float)
+        frame['revenue'] = frame['revenue'].astype(float)
+        daily = frame.groupby(['asin', 'ds'])[['y', 'revenue']].sum()
+        dates = pd.date_range(
+            daily.index.get_level_values('ds').min(), daily.index.get_level_values('ds').max(), freq='D'
+        )
+        units = daily['y'].unstack().reindex(index=asins, columns=dates)
+        revenue = daily['revenue'].unstack().reindex(index=asins, columns=dates)
+        
+        Y = units.to_numpy()
+        started = np.cumsum(~np.isnan(Y), axis=1) > 0
+        Y = np.where(started & np.isnan(Y), 0.0, Y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prices = np.where(Y > 0, revenue.to_numpy() / Y, np.nan)
+        return dates, Y, prices
+    
+    def _batch_results(self, asins, valid, future_dates, fit, product_infos, model_name):
+        """Monta as previsões de um motor de catálogo, em tuplas
+        (asin, forecast, error) na ordem de `asins`, uma de cada vez"""
+        position = {asin: i for i, asin in enumerate(valid)}
+        for asin in asins:
+            i = position.get(asin)
+            if i is None:
+                yield asin, None, None
+                continue
+            try:
+                future_forecast = {
+                    'ds': future_dates,
+                    'yhat': fit['yhat'][i],
+                    'yhat_lower': fit['yhat_lower'][i],
+                    'yhat_upper': fit['yhat_upper'][i],
+                    'trend': fit['trend'][i],
+                    'weekly': fit['weekly'][i],
+                    'holidays': fit['holidays'][i]
+                }
+                trend = fit['trend'][i]
+                growth_trend = 'increasing' if trend[-1] > trend[0] else 'stable'
+                mape = None if np.isnan(fit['mape'][i]) else float(fit['mape'][i])
+                product_info = product_infos.get(asin) or self.get_product_info(asin)
+                yield asin, self._build_forecast_result(
+                    asin, product_info, future_forecast, mape, growth_trend, model_name=model_name
+                ), None
+            except Exception as e:
+                yield asin, None, str(e)
+    
+    def forecast_batch_ets(self, asins, forecast_days, histories, product_infos):
+        """Previsão de todos os ASINs com CatalogETS em uma única passada.
+        
+        Retorna tuplas (asin, forecast, error) na ordem de `asins`, no mesmo
+        formato de _run_forecasts.
+        """
+        valid = [asin for asin in asins if len(histories.get(asin, _EMPTY_HISTORY)) >= 30]
+        if not valid:
+            return [(asin, None, None) for asin in asins]
+            
+        dates, Y, _ = self._history_matrix(valid, histories)
+        future_dates = pd.date_range(dates[-1] + timedelta(days=1), periods=forecast_days, freq='D')
+        events = None
+        if self.event_calendar is not None:
+            _, events = event_indicators(self.event_calendar, dates.append(future_dates))
+        fit = CatalogETS().fit_predict(Y, forecast_days, events)
+        
+        return self._batch_results(asins, valid, future_dates, fit, product_infos, 'ets')
+    
+    def forecast_batch_lightgbm(self, asins, forecast_days, histories, product_infos):
+        """Previsão de todos os ASINs com um único modelo global CatalogGBM.
+        
+        Retorna tuplas (asin, forecast, error) na ordem de `asins`, no mesmo
+        formato de _run_forecasts.
+        """
+        valid = [asin for asin in asins if len(histories.get(asin, _EMPTY_HISTORY)) >= 30]
+        if not valid:
+            return [(asin, None, None) for asin in asins]
+            
+        dates, Y, prices = self._history_matrix(valid, histories)
+        future_dates = pd.date_range(dates[-1] + timedelta(days=1), periods=forecast_days, freq='D')
+        all_dates = dates.append(future_dates)
+        events = None
+        if self.event_calendar is not None:
+            _, events = event_indicators(self.event_calendar, all_dates)
+        try:
+            fit = CatalogGBM().fit_predict(Y, forecast_days, all_dates, prices, events)
+        except Exception as e:
+            # Modelo único: uma falha no treino vale para todos os ASINs
+            return [(asin, None, str(e) if asin in valid else None) for asin in asins]
+            
+        return self._batch_results(asins, valid, future_dates, fit, product_infos, 'lightgbm')
+    
+    def benchmark_engines(self, params):
+        """Compara vazão e MAPE dos motores em uma janela de validação.
+        
+        Os últimos `holdout_days` de cada ASIN ficam fora do treino; cada
+        motor prevê esse período e é avaliado contra as vendas reais.
+        """
+        holdout_days = params.get('holdout_days', 14)
+        engines = params.get('engines', list(ENGINES))
+        self.configure({'model_cache': False, 'output_format': 'rows'})
+        
+        products = self.get_forecast_candidates(params.get('limit', 50))
+        asins = [product['asin'] for product in products]
+        histories, product_infos = self.load_forecast_inputs(asins)
+        
+        # Separar treino e validação por data
+        train, actuals = {}, {}
+        for asin, history in histories.items():
+            history = history.copy()
+            history['ds'] = pd.to_datetime(history['ds'])
+            cutoff = history['ds'].max() - timedelta(days=holdout_days)
+            train[asin] = history[history['ds'] <= cutoff].reset_index(drop=True)
+            actual = history[history['ds'] > cutoff].groupby('ds')['y'].sum()
+            actuals[asin] = {ds.strftime('%Y-%m-%d'): float(y) for ds, y in actual.items()}
+            
+        report = {}
+        for engine in engines:
+            started = time.perf_counter()
+            if engine == 'ets':
+                results = self.forecast_batch_ets(asins, holdout_days, train, product_infos)
+            elif engine == 'lightgbm':
+                results = self.forecast_batch_lightgbm(asins, holdout_days, train, product_infos)
+            else:
+                results = self._run_forecasts(
+                    asins, holdout_days, int(params.get('workers') or 1), train, product_infos,
+                    {'model_cache': False}
+                )
+            results = list(results)
+            elapsed = time.perf_counter() - started
+            
+            abs_errors, total_actual, pct_errors, forecasted = 0.0, 0.0, [], 0
+            for asin, forecast, error in results:
+                if not forecast:
+                    continue
+                forecasted += 1
+                for daily in forecast['daily_forecasts']:
+                    actual = actuals[asin].get(daily['date'], 0.0)
+                    abs_errors += abs(daily['units_forecast'] - actual)
+                    total_actual += actual
+                    if actual > 0:
+                        pct_errors.append(abs(daily['units_forecast'] - actual) / actual)
+                        
+            report[engine] = {
+                'seconds': round(elapsed, 3),
+                'series_per_second': round(forecasted / elapsed, 2) if elapsed > 0 else None,
+                'forecasts': forecasted,
+                'errors': sum(1 for _, _, error in results if error),
+                'mape': round(float(np.mean(pct_errors)), 4) if pct_errors else None,
+                'wape': round(abs_errors / total_actual, 4) if total_actual else None
+            }
+            
+        return {
+            'success': True,
+            'data': {
+                'holdout_days': holdout_days,
+                'total_products': len(asins),
+                'engines': report,
+                'timestamp': datetime.now().isoformat()
+            }
+        }
+    
+    def benchmark_intervals(self, params):
+        """Compara tempo de predict e cobertura dos modos de intervalo.
+        
+        Cada ASIN é treinado uma vez sem os últimos `holdout_days`; cada modo
+        prevê esse período e a cobertura é a fração dos dias reais dentro de
+        [yhat_lower, yhat_upper].
+        """
+        holdout_days = params.get('holdout_days', 14)
+        modes = params.get('interval_modes', list(INTERVAL_MODES))
+        self.configure({'model_cache': False})
+        
+        products = self.get_forecast_candidates(params.get('limit', 20))
+        asins = [product['asin'] for product in products]
+        histories, _ = self.load_forecast_inputs(asins)
+        
+        totals = {mode: {'seconds': 0.0, 'inside': 0, 'days': 0, 'width': 0.0} for mode in modes}
+        errors = []
+        for asin in asins:
+            history = histories.get(asin)
+            if history is None or len(history) < 30 + holdout_days:
+                continue
+            try:
+                df = self._prepare_history(history)
+                cutoff = df['ds'].max() - timedelta(days=holdout_days)
+                train = df[df['ds'] <= cutoff]
+                actual = df[df['ds'] > cutoff].groupby('ds')['y'].sum()
+                model = self._build_model(train)
+                model.fit(train)
+                future = model.make_future_dataframe(periods=holdout_days)
+                future['cap'] = train['cap'].max()
+                future['floor'] = 0
+                future['is_weekend'] = (future['ds'].dt.dayofweek >= 5).astype(int)
+                
+                for mode in modes:
+                    started = time.perf_counter()
+                    forecast = self._predict(model, future, mode)
+                    totals[mode]['seconds'] += time.perf_counter() - started
+                    
+                    forecast = forecast.set_index('ds').reindex(actual.index)
+                    lower, upper = forecast['yhat_lower'].to_numpy(), forecast['yhat_upper'].to_numpy()
+                    values = actual.to_numpy()
+                    totals[mode]['inside'] += int(((values >= lower) & (values <= upper)).sum())
+                    totals[mode]['days'] += len(values)
+                    totals[mode]['width'] += float(np.nansum(upper - lower))
+            except Exception as e:
+                errors.append({'asin': asin, 'error': str(e)})
+                
+        report = {}
+        for mode, total in totals.items():
+            report[mode] = {
+                'predict_seconds': round(total['seconds'], 3),
+                'coverage': round(total['inside'] / total['days'], 4) if total['days'] else None,
+                'mean_width': round(total['width'] / total['days'], 3) if total['days'] else None
+            }
+        baseline = report.get('sampled', {}).get('predict_seconds')
+        for mode in report:
+            seconds = report[mode]['predict_seconds']
+            report[mode]['speedup'] = round(baseline / seconds, 2) if baseline and seconds else None
+            
+        return {
+            'success': True,
+            'data': {
+                'holdout_days': holdout_days,
+                'total_products': len(asins),
+                'interval_modes': report,
+                'errors': errors,
+                'timestamp': datetime.now().isoformat()
+            }
+        }
+    
+    def _run_forecasts(self, asins, forecast_days, workers=1, histories=None, product_infos=None,
+                       params=None, deadline=None):
+        """Executa as previsões em sequência ou em um pool de processos.
+        
+        Retorna tuplas (asin, forecast, error) sempre na ordem de `asins`.
+        Quando `histories`/`product_infos` são informados, cada previsão
+        recebe sua fatia pré-carregada e não consulta o banco. Com `deadline`
+        (time.monotonic), para de entregar resultados ao chegar no prazo,
+        cancela o que ainda não começou e encerra os processos em andamento.
+        """
+        if histories is None:
+            tasks = [(asin, forecast_days, None, None) for asin in asins]
+        else:
+            product_infos = product_infos or {}
+            tasks = [
+                (asin, forecast_days, histories.get(asin, _EMPTY_HISTORY), product_infos.get(asin))
+                for asin in asins
+            ]
+        
+        if workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                if deadline and time.monotonic() >= deadline:
+                    return
+                yield _forecast_one(self, *task)
+            return
+            
+        workers = min(workers, len(tasks), os.cpu_count() or 1)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(params or {},))
+        expired = False
+        try:
+            futures = [executor.submit(_forecast_in_worker, task) for task in tasks]
+            # Resultados na ordem de entrada, independente de qual processo termina antes
+            for future in futures:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    yield future.result(timeout=timeout)
+                except FuturesTimeout:
+                    expired = True
+                    return
+        finally:
+            if expired:
+                # Prazo estourado: tarefas em andamento não prendem a saída
+                _terminate_pool(executor)
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+_EMPTY_HISTORY = pd.DataFrame(columns=['ds', 'y'])
+
+
+def _forecast_one(forecaster, asin, forecast_days, history=None, product_info=None):
+    """Previsão de um ASIN, capturando o erro para a lista de erros"""
+    try:
+        forecast = forecaster.forecast_demand(asin, forecast_days, history, product_info)
+        return asin, forecast, None
+    except Exception as e:
+        return asin, None, str(e)
+
+
+_worker_forecaster = None
+
+
+def _init_worker(params):
+    """Inicializa o forecaster uma vez por processo do pool"""
+    global _worker_forecaster
+    if hasattr(os, 'setpgrp'):
+        # Grupo de processos próprio: _terminate_pool encerra o worker junto
+        # com o processo do Stan que ele estiver rodando
+        os.setpgrp()
+    _worker_forecaster = DemandForecaster()
+    _worker_forecaster.configure(params)
+
+
+def _terminate_pool(executor):
+    """Encerra os processos do pool, com os filhos do Stan de cada um"""
+    for process in list((executor._processes or {}).values()):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except (AttributeError, OSError):
+            # Sem killpg, ou o worker ainda não criou seu grupo
+            process.terminate()
+
+
+def _forecast_in_worker(task):
+    """Ponto de entrada de cada tarefa no pool de processos"""
+    return _forecast_one(_worker_forecaster, *task)
+
+
+def merge_shard_results(results):
+    """Junta as saídas de forecast_all de cada shard em uma só.
+    
+    Previsões são reordenadas por ASIN (mesma ordem de uma execução sem
+    shards), contadores e estatísticas são somados e shards ausentes ou
+    com falha são listados em `shard`.
+    """
+    shard_count = None
+    seen = set()
+    failed = []
+    merged = {
+        'forecasts': [],
+        'total_products': 0,
+        'successful_forecasts': 0,
+        'errors': 0,
+        'error_details': [],
+        'cv_error_details': [],
+        'engine': None,
+        'model_cache': {},
+        'cross_validation': {},
+        'refreshed': 0,
+        'skipped': 0,
+        'skipped_asins': [],
+        'fallbacks': 0,
+        'fallback_asins': [],
+        'unprocessed': 0,
+        'unprocessed_asins': []
+    }
+    
+    for result in results:
+        if not result.get('success'):
+            failed.append(result.get('error'))
+            continue
+        data = result['data']
+        shard = data.get('shard', {'index': 0, 'count': 1})
+        if shard_count is None:
+            shard_count = shard['count']
+        elif shard['count'] != shard_count:
+            return {
+                'success': False,
+                'error': f'Mismatched shard_count: {shard["count"]} != {shard_count}'
+            }
+        if shard['index'] in seen:
+            return {'success': False, 'error': f'Duplicate shard_index: {shard["index"]}'}
+        seen.add(shard['index'])
+        
+        for key in ('forecasts', 'error_details', 'cv_error_details', 'skipped_asins', 'fallback_asins',
+                    'unprocessed_asins'):
+            merged[key].extend(data.get(key, []))
+        for key in ('total_products', 'successful_forecasts', 'errors', 'refreshed', 'skipped',
+                    'fallbacks', 'unprocessed'):
+            merged[key] += data.get(key, 0)
+        for key in ('model_cache', 'cross_validation'):
+            for stat, value in data.get(key, {}).items():
+                merged[key][stat] = merged[key].get(stat, 0) + value
+        merged['engine'] = merged['engine'] or data.get('engine')
+        
+    if shard_count is None:
+        return {'success': False, 'error': 'No successful shard results to merge'}
+        
+    merged['forecasts'].sort(key=lambda forecast: forecast['asin'])
+    for key in ('error_details', 'cv_error_details'):
+        merged[key].sort(key=lambda error: error['asin'])
+    for key in ('skipped_asins', 'fallback_asins', 'unprocessed_asins'):
+        merged[key].sort()
+    merged['shard'] = {
+        'count': shard_count,
+        'merged': sorted(seen),
+        'missing': [index for index in range(shard_count) if index not in seen],
+        'failed': failed
+    }
+    merged['timestamp'] = datetime.now().isoformat()
+    return {'success': True, 'data': merged}
+
 
 def main():
     """Função principal"""
@@ -260,8 +2048,24 @@ def main():
     
     forecaster = DemandForecaster()
     
-    if input_data.get('command') == 'forecast_all':
+    if input_data.get('command') == 'forecast_all' and input_data.get('params', {}).get('stream'):
+        # NDJSON: uma linha por previsão assim que fica pronta, resumo no fim.
+        # Com persist, as previsões já vão para o banco e só o resumo sai
+        def emit(forecast):
+            print(json.dumps(json_safe({'type': 'forecast', 'data': forecast})), flush=True)
+        params = input_data['params']
+        result = forecaster.forecast_all_products(
+            params, on_forecast=None if params.get('persist') else emit
+        )
+        result = {'type': 'summary', **result}
+    elif input_data.get('command') == 'forecast_all':
         result = forecaster.forecast_all_products(input_data.get('params', {}))
+    elif input_data.get('command') == 'benchmark_engines':
+        result = forecaster.benchmark_engines(input_data.get('params', {}))
+    elif input_data.get('command') == 'benchmark_intervals':
+        result = forecaster.benchmark_intervals(input_data.get('params', {}))
+    elif input_data.get('command') == 'merge_shards':
+        result = merge_shard_results(input_data.get('params', {}).get('results', []))
     else:
         result = {
             'success': False,
@@ -269,7 +2073,7 @@ def main():
         }
     
     # Retornar resultado
-    print(json.dumps(result))
+    print(json.dumps(json_safe(result)))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+Serialização JSON das saídas dos scripts de IA
+O backend Node.js faz JSON.parse em stdout (e nas linhas NDJSON), que
+rejeita NaN e Infinity; as saídas passam por json_safe antes do dumps.
+"""
+
+import numpy as np
+
+
+def json_safe(value):
+    """Copia de `value` serializável como JSON válido: NaN e infinitos
+    (ex.: preço de competidor ausente, MAPE sem avaliação) viram None,
+    escalares numpy viram tipos Python"""
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
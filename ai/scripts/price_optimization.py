@@ -13,19 +13,531 @@ import json
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.linear_model import LinearRegression, LogisticRegression, Ridge
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.metrics import log_loss, mean_absolute_error, r2_score, roc_auc_score
+from scipy import sparse
+from scipy.sparse.linalg import lsqr
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import os
+import time
+import signal
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
 from dotenv import load_dotenv
 import warnings
+from competitor_rollup import competitor_summary_sql
+from json_utils import json_safe
 warnings.filterwarnings('ignore')
 
 load_dotenv()
 
+CACHE_DIR = os.getenv(
+    'AI_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache')
+)
+
+# Colunas de get_price_history / load_price_histories
+PRICE_HISTORY_COLUMNS = [
+    'date', 'units_ordered', 'ordered_product_sales', 'sessions', 'buy_box_percentage',
+    'price', 'cost', 'margin', 'min_competitor_price', 'avg_competitor_price',
+    'competitor_count', 'buy_box_price', 'price_gap_pct'
+]
+
+def elasticity_design(df):
+    """Matriz X (intercepto, log_price, buy_box_percentage, is_weekend) e
+    y = log(unidades + 1) da regressão log-log de elasticidade"""
+    df = df.copy()
+    df['log_price'] = np.log(df['price'].astype(float))
+    df['log_quantity'] = np.log(df['units_ordered'].astype(float) + 1)  # +1 para evitar log(0)
+    df['is_weekend'] = pd.to_datetime(df['date']).dt.dayofweek.isin([5, 6]).astype(int)
+    X = np.column_stack([
+        np.ones(len(df)),
+        df[['log_price', 'buy_box_percentage', 'is_weekend']].to_numpy(dtype=float)
+    ])
+    y = df['log_quantity'].to_numpy(dtype=float)
+    mask = ~np.isnan(X).any(axis=1) & ~np.isnan(y)
+    return X[mask], y[mask], pd.to_datetime(df['date']).to_numpy()[mask]
+
+
+def solve_elasticity(xtx, xty, n, min_rows=10):
+    """Elasticidade (coeficiente de log_price) a partir de X'X e X'y"""
+    if n < min_rows:
+        return -2.0  # Elasticidade padrão
+    xtx = np.asarray(xtx, dtype=float)
+    try:
+        # Regularização mínima só para estabilizar colunas quase constantes
+        beta = np.linalg.solve(xtx + 1e-6 * np.eye(len(xtx)), np.asarray(xty, dtype=float))
+    except np.linalg.LinAlgError:
+        return -2.0
+    # Limitar elasticidade a valores razoáveis
+    return float(np.clip(beta[1], -5.0, -0.5))
+
+
+def bootstrap_elasticities(designs, resamples=200, rng=None, min_rows=10, chunk_size=50):
+    """Elasticidades de `resamples` reamostragens bootstrap de cada ASIN.
+    
+    `designs` é uma lista de (X, y) de elasticity_design. Os ASINs de cada
+    bloco são preenchidos até o mesmo número de linhas (linhas vazias não
+    entram em X'X), e todas as regressões do bloco saem de um único
+    np.linalg.solve em lote. Retorna (N, resamples); -2.0 para ASINs com
+    menos de `min_rows` linhas, como em solve_elasticity.
+    """
+    rng = rng or np.random.default_rng()
+    draws = np.full((len(designs), resamples), -2.0)
+    for start in range(0, len(designs), chunk_size):
+        chunk = [
+            (i, X, y) for i, (X, y) in enumerate(designs[start:start + chunk_size], start)
+            if len(X) >= min_rows
+        ]
+        if not chunk:
+            continue
+        lengths = np.array([len(X) for _, X, _ in chunk])
+        rows = lengths.max()
+        X_pad = np.zeros((len(chunk), rows, chunk[0][1].shape[1]))
+        y_pad = np.zeros((len(chunk), rows))
+        for k, (_, X, y) in enumerate(chunk):
+            X_pad[k, :len(X)] = X
+            y_pad[k, :len(y)] = y
+            
+        # Índices com reposição dentro das linhas de cada ASIN: (c, B, L)
+        index = (rng.random((len(chunk), resamples, rows)) * lengths[:, None, None]).astype(int)
+        valid = (np.arange(rows) < lengths[:, None])[:, None, :]
+        owner = np.arange(len(chunk))[:, None, None]
+        X_boot = X_pad[owner, index] * valid[..., None]
+        y_boot = y_pad[owner, index] * valid
+        
+        X_boot_t = X_boot.swapaxes(-1, -2)
+        xtx = X_boot_t @ X_boot                  # (c, B, k, k)
+        xty = (X_boot_t @ y_boot[..., None])[..., 0]
+        beta = np.linalg.solve(xtx + 1e-6 * np.eye(xtx.shape[-1]), xty[..., None])[..., 0]
+        draws[[i for i, _, _ in chunk]] = np.clip(beta[..., 1], -5.0, -0.5)
+    return draws
+
+
+class ElasticityStore:
+    """Estatísticas suficientes da regressão de elasticidade por ASIN.
+    
+    Guarda X'X, X'y e o número efetivo de linhas com decaimento exponencial
+    no tempo (`half_life_days`), o número bruto de linhas e a última data
+    incorporada. A cada execução só os dias novos e já encerrados entram nos
+    acumuladores (o dia corrente ainda é parcial), e a elasticidade sai de
+    um sistema 4×4. Correções em dias já incorporados não são relidas.
+    """
+    
+    VERSION = 2  # Mudar ao alterar as colunas de elasticity_design ou a entrada
+    
+    def __init__(self, path=None, half_life_days=30):
+        self.path = path or os.path.join(CACHE_DIR, 'price_elasticity.json')
+        self.decay = 0.5 ** (1 / half_life_days)
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        if self.data.get('version') != self.VERSION:
+            self.data = {'version': self.VERSION, 'asins': {}}
+    
+    def update(self, asin, df, today=None):
+        """Incorpora as linhas de `df` posteriores à última data do ASIN e
+        anteriores a `today` (padrão: hoje)"""
+        X, y, dates = elasticity_design(df)
+        keep = dates < np.datetime64(today or datetime.now().date(), 'D')
+        entry = self.data['asins'].get(asin)
+        if entry:
+            keep &= dates > np.datetime64(entry['last_date'])
+        X, y, dates = X[keep], y[keep], dates[keep]
+        if len(X) == 0:
+            return entry
+            
+        last_date = dates.max()
+        age = ((last_date - dates) / np.timedelta64(1, 'D')).astype(float)
+        weights = self.decay ** age
+        xtx = (X * weights[:, None]).T @ X
+        xty = (X * weights[:, None]).T @ y
+        n = float(weights.sum())
+        rows = len(X)
+        
+        if entry:
+            # Acumuladores antigos envelhecem até a nova última data
+            elapsed = (last_date - np.datetime64(entry['last_date'])) / np.timedelta64(1, 'D')
+            factor = self.decay ** float(elapsed)
+            xtx += factor * np.asarray(entry['xtx'])
+            xty += factor * np.asarray(entry['xty'])
+            n += factor * entry['n']
+            rows += entry['rows']
+            
+        entry = {
+            'xtx': xtx.tolist(),
+            'xty': xty.tolist(),
+            'n': n,
+            'rows': rows,
+            'last_date': str(pd.Timestamp(last_date).date())
+        }
+        self.data['asins'][asin] = entry
+        return entry
+    
+    def elasticity(self, asin):
+        """Elasticidade atual do ASIN (-2.0 sem dados suficientes)"""
+        entry = self.data['asins'].get(asin)
+        if not entry:
+            return -2.0
+        # Mínimo de linhas sobre a contagem bruta: o peso decaído cai abaixo
+        # de min_rows mesmo com meses de histórico
+        return solve_elasticity(entry['xtx'], entry['xty'], entry['rows'])
+    
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+
+class CrossElasticityModel:
+    """Elasticidades cruzadas entre ASINs do catálogo.
+    
+    Dois ASINs são vizinhos quando disputam com os mesmos vendedores em
+    competitor_tracking_advanced. A matriz ASIN×vendedor é esparsa, e a
+    co-ocorrência (B·Bᵀ) mantém só os `max_neighbors` vizinhos mais fortes
+    de cada ASIN; vendedores presentes em mais de `max_seller_share` do
+    catálogo (ex.: a própria Amazon) não contam. Todos os efeitos são
+    ajustados em uma única regressão esparsa (lsqr com ridge):
+    
+        log(q_i,t) = e_i·log(p_i,t) + Σ_j c_ij·log(p_j,t)     (centrados por ASIN)
+    
+    com N·(1 + max_neighbors) coeficientes, sem termos N². O resultado
+    fica em cache em JSON até `ttl_hours`.
+    """
+    
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, 'cross_elasticity.json')
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault('asins', {})
+    
+    def is_fresh(self, asins, ttl_hours=24):
+        """True se o ajuste em cache é recente e cobre todos os `asins`"""
+        fitted_at = self.data.get('fitted_at')
+        if not fitted_at:
+            return False
+        age = datetime.now() - datetime.fromisoformat(fitted_at)
+        return age < timedelta(hours=ttl_hours) and all(asin in self.data['asins'] for asin in asins)
+    
+    def get(self, asin):
+        """{vizinho: elasticidade cruzada} do ASIN"""
+        return self.data['asins'].get(asin, {})
+    
+    def matrix(self, asins):
+        """Matriz esparsa N×N das elasticidades cruzadas na ordem de `asins`"""
+        index = {asin: i for i, asin in enumerate(asins)}
+        rows, cols, values = [], [], []
+        for i, asin in enumerate(asins):
+            for neighbor, coef in self.get(asin).items():
+                if neighbor in index:
+                    rows.append(i)
+                    cols.append(index[neighbor])
+                    values.append(coef)
+        return sparse.csr_matrix((values, (rows, cols)), shape=(len(asins), len(asins)))
+    
+    @staticmethod
+    def neighbors(asins, seller_pairs, max_neighbors=5, max_seller_share=0.2):
+        """Vizinhos de cada ASIN pela co-ocorrência de vendedores.
+        
+        Retorna uma matriz (N, max_neighbors) de índices em `asins`, -1 onde
+        faltam vizinhos.
+        """
+        index = {asin: i for i, asin in enumerate(asins)}
+        pairs = [(index[asin], seller) for asin, seller in seller_pairs if asin in index]
+        sellers = {seller: k for k, seller in enumerate(sorted({seller for _, seller in pairs}))}
+        result = np.full((len(asins), max_neighbors), -1)
+        if not pairs:
+            return result
+            
+        incidence = sparse.csr_matrix(
+            (np.ones(len(pairs)), ([i for i, _ in pairs], [sellers[seller] for _, seller in pairs])),
+            shape=(len(asins), len(sellers))
+        )
+        incidence.data[:] = 1.0  # Pares repetidos contam uma vez
+        coverage = np.asarray(incidence.sum(axis=0)).ravel()
+        keep = coverage <= max(2, max_seller_share * len(asins))
+        incidence = incidence[:, np.flatnonzero(keep)]
+        
+        shared = (incidence @ incidence.T).tocsr()
+        shared.setdiag(0)
+        shared.eliminate_zeros()
+        for i in range(len(asins)):
+            start, end = shared.indptr[i], shared.indptr[i + 1]
+            if start == end:
+                continue
+            cols, weights = shared.indices[start:end], shared.data[start:end]
+            top = cols[np.argsort(-weights, kind='stable')[:max_neighbors]]
+            result[i, :len(top)] = top
+        return result
+    
+    def fit(self, histories, seller_pairs, max_neighbors=5, max_seller_share=0.2, ridge=0.1):
+        """Ajusta todas as elasticidades cruzadas em uma regressão esparsa.
+        
+        `histories` é {asin: DataFrame} no formato de get_price_history e
+        `seller_pairs` a lista de (asin, competitor_seller_id) observados.
+        """
+        asins = sorted(histories)
+        neighbors = self.neighbors(asins, seller_pairs, max_neighbors, max_seller_share)
+        
+        # Matrizes ASIN×dia de log-preço e log-unidades, centradas por ASIN
+        frame = pd.concat(
+            [histories[asin][['date', 'price', 'units_ordered']].assign(asin=asin) for asin in asins],
+            ignore_index=True
+        )
+        frame['date'] = pd.to_datetime(frame['date'])
+        daily = frame.groupby(['asin', 'date']).agg(price=('price', 'mean'), units=('units_ordered', 'sum'))
+        log_price = np.log(daily['price'].astype(float).unstack().reindex(asins))
+        log_units = np.log(daily['units'].astype(float).unstack().reindex(asins) + 1)
+        log_price = (log_price.sub(log_price.mean(axis=1), axis=0)).to_numpy()
+        log_units = (log_units.sub(log_units.mean(axis=1), axis=0)).to_numpy()
+        prices = np.nan_to_num(log_price)  # Sem preço no dia = preço médio
+        
+        # Uma linha por (ASIN, dia) observado; colunas [própria, vizinhos...]
+        obs_asin, obs_day = np.nonzero(~np.isnan(log_units) & ~np.isnan(log_price))
+        width = 1 + max_neighbors
+        neighbor_cols = neighbors[obs_asin]                                # R×K
+        values = np.column_stack([
+            prices[obs_asin, obs_day],
+            np.where(neighbor_cols >= 0, prices[np.maximum(neighbor_cols, 0), obs_day[:, None]], 0.0)
+        ])
+        cols = obs_asin[:, None] * width + np.arange(width)
+        rows = np.repeat(np.arange(len(obs_asin)), width)
+        design = sparse.csr_matrix(
+            (values.ravel(), (rows, cols.ravel())), shape=(len(obs_asin), len(asins) * width)
+        )
+        coefs = lsqr(design, log_units[obs_asin, obs_day], damp=np.sqrt(ridge))[0].reshape(len(asins), width)
+        
+        self.data = {'fitted_at': datetime.now().isoformat(), 'asins': {}}
+        for i, asin in enumerate(asins):
+            self.data['asins'][asin] = {
+                asins[j]: round(float(np.clip(coefs[i, 1 + k], -2.0, 2.0)), 4)
+                for k, j in enumerate(neighbors[i]) if j >= 0
+            }
+        return self
+    
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+
+class BuyBoxModel:
+    """Probabilidade de ganhar a Buy Box aprendida do histórico.
+    
+    Regressão logística sobre as ofertas de competitor_tracking_advanced:
+    cada oferta de um snapshot (ASIN, timestamp) com vencedor conhecido é
+    um exemplo, com log da razão entre o preço da oferta e o menor preço
+    das outras, rating do vendedor, log do número de ofertas e FBA. Os
+    coeficientes ficam em JSON no CACHE_DIR; o score é uma combinação
+    linear com broadcast, barata o bastante para grades N×G inteiras.
+    
+    O rating entra em estrelas (0–5): feedback_rating vem do SP-API como
+    percentual positivo (0–100) e é dividido por 20 (ver rating_scale).
+    Ratings ausentes recebem a mediana do treino.
+    """
+    
+    VERSION = 2  # Mudar ao alterar as features
+    FEATURES = ['log_price_ratio', 'rating', 'log_seller_count', 'is_fba']
+    
+    # O LIMIT vale para snapshots inteiros: cortar ofertas de um snapshot
+    # mudaria o menor preço das outras e o número de ofertas
+    TRAINING_QUERY = """
+    WITH snapshots AS (
+        SELECT asin, timestamp
+        FROM competitor_tracking_advanced
+        WHERE timestamp >= NOW() - INTERVAL '%s days'
+        AND price > 0
+        GROUP BY asin, timestamp
+        HAVING BOOL_OR(is_buy_box_winner) AND COUNT(*) >= 2
+        ORDER BY timestamp DESC
+        LIMIT %s
+    ),
+    offers AS (
+        SELECT
+            c.asin,
+            c.timestamp,
+            COALESCE(c.total_price, c.price) as offer_price,
+            c.feedback_rating,
+            c.is_fba,
+            c.is_buy_box_winner,
+            COUNT(*) OVER snapshot as seller_count,
+            MIN(COALESCE(c.total_price, c.price)) OVER (
+                snapshot ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING EXCLUDE CURRENT ROW
+            ) as others_min_price
+        FROM competitor_tracking_advanced c
+        JOIN snapshots s ON s.asin = c.asin AND s.timestamp = c.timestamp
+        WHERE c.price > 0
+        WINDOW snapshot AS (PARTITION BY c.asin, c.timestamp)
+    )
+    SELECT
+        timestamp,
+        offer_price / others_min_price as price_ratio,
+        feedback_rating as rating,
+        seller_count,
+        COALESCE(is_fba, false) as is_fba,
+        is_buy_box_winner as won
+    FROM offers
+    WHERE others_min_price > 0
+    """
+    
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, 'buy_box_model.json')
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        if self.data.get('version') != self.VERSION:
+            self.data = {'version': self.VERSION}
+    
+    @property
+    def is_fitted(self):
+        return 'coef' in self.data
+    
+    def is_fresh(self, ttl_hours=24):
+        """True se há um ajuste com menos de `ttl_hours`"""
+        if not self.is_fitted:
+            return False
+        age = datetime.now() - datetime.fromisoformat(self.data['fitted_at'])
+        return age < timedelta(hours=ttl_hours)
+    
+    @staticmethod
+    def rating_scale(rating):
+        """Rating em estrelas (0–5); valores acima de 5 são percentuais de
+        feedback positivo (0–100) e viram percentual / 20. NaN é mantido."""
+        rating = np.asarray(np.nan if rating is None else rating, dtype=float)
+        return np.where(rating > 5, rating / 20, rating)
+    
+    @classmethod
+    def features(cls, price_ratio, rating, seller_count, is_fba, rating_fill=4.5):
+        """Colunas do modelo; aceita escalares ou arrays (com broadcast)"""
+        return [
+            np.log(np.clip(price_ratio, 0.5, 2.0)),
+            np.nan_to_num(cls.rating_scale(rating), nan=rating_fill),
+            np.log(np.maximum(seller_count, 1)),
+            np.asarray(is_fba, dtype=float)
+        ]
+    
+    def predict(self, price_ratio, rating, seller_count, is_fba=1.0):
+        """Probabilidade de ganhar a Buy Box (arrays com broadcast), limitada
+        a 5–95% como a curva fixa. `rating` None usa a mediana do treino."""
+        z = self.data['intercept']
+        columns = self.features(price_ratio, rating, seller_count, is_fba, self.data['rating_median'])
+        for coef, column in zip(self.data['coef'], columns):
+            z = z + coef * column
+        return np.clip(1 / (1 + np.exp(-z)), 0.05, 0.95)
+    
+    def fit(self, df, holdout_fraction=0.2):
+        """Ajusta o modelo em `df` (colunas de TRAINING_QUERY).
+        
+        Os snapshots mais recentes (`holdout_fraction` dos timestamps) ficam
+        de fora do primeiro ajuste para medir log loss e AUC contra a curva
+        fixa anterior. O corte é por timestamp, então as ofertas de um
+        snapshot (que competem entre si) caem todas do mesmo lado. O modelo
+        final é reajustado com todas as linhas.
+        """
+        df = df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+        ratings = self.rating_scale(df['rating'].astype(float))
+        rating_median = float(np.nanmedian(ratings)) if np.isfinite(ratings).any() else 4.5
+        X = np.column_stack(self.features(
+            df['price_ratio'].astype(float), ratings,
+            df['seller_count'].astype(float), df['is_fba'].astype(float), rating_median
+        ))
+        y = df['won'].astype(int).to_numpy()
+        
+        timestamps = df['timestamp'].drop_duplicates()
+        cut = int(len(timestamps) * (1 - holdout_fraction))
+        split = (
+            int(df['timestamp'].searchsorted(timestamps.iloc[cut], side='left'))
+            if cut < len(timestamps) else len(df)
+        )
+        metrics = {}
+        if 0 < split < len(df) and len(np.unique(y[:split])) == 2 and len(np.unique(y[split:])) == 2:
+            model = LogisticRegression(max_iter=1000).fit(X[:split], y[:split])
+            learned = np.clip(model.predict_proba(X[split:])[:, 1], 0.05, 0.95)
+            # Curva fixa anterior: -20 * (razão - 1) + 0.5 * (rating - 4)
+            ratio = np.exp(X[split:, 0])
+            z = -20 * (ratio - 1.0) + 0.5 * (X[split:, 1] - 4.0)
+            fixed = np.clip(1 / (1 + np.exp(-z)), 0.05, 0.95)
+            for name, probability in (('learned', learned), ('fixed_curve', fixed)):
+                metrics[name] = {
+                    'log_loss': round(float(log_loss(y[split:], probability)), 4),
+                    'auc': round(float(roc_auc_score(y[split:], probability)), 4)
+                }
+            metrics['holdout_rows'] = len(df) - split
+        
+        model = LogisticRegression(max_iter=1000).fit(X, y)
+        self.data = {
+            'version': self.VERSION,
+            'fitted_at': datetime.now().isoformat(),
+            'features': self.FEATURES,
+            'intercept': float(model.intercept_[0]),
+            'coef': [float(value) for value in model.coef_[0]],
+            'rating_median': round(rating_median, 3),
+            'training_rows': len(df),
+            'win_rate': round(float(y.mean()), 4),
+            'metrics': metrics
+        }
+        return self
+    
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+
+class TTLCache:
+    """Cache em memória com expiração por entrada, seguro entre threads"""
+    
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+    
+    def get(self, key):
+        """Valor em cache ou None se ausente/expirado"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+    
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+    
+    def invalidate(self, match=None):
+        """Remove as entradas cuja chave satisfaz `match` (todas se None)"""
+        with self.lock:
+            for key in [key for key in self.entries if match is None or match(key)]:
+                del self.entries[key]
+    
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
 class PriceOptimizer:
     def __init__(self):
         self.db_config = {
@@ -35,13 +547,65 @@ class PriceOptimizer:
             'user': os.getenv('DB_USER', 'postgres'),
             'password': os.getenv('DB_PASSWORD')
         }
+        self.elasticity_store = None
+        self.cross_model = None
+        self.buy_box_model = None
+        self.seller_rating = None  # Nosso feedback_rating em sellers_cache (ver load_seller_rating)
+        # Usados pelo modo serviço (ver PricingService)
+        self.pool = None
+        self.pool_slots = None
+        self.history_cache = None
+        self.elasticity_cache = None
+        
+    def configure(self, params):
+        """Aplica opções da execução que valem para todos os ASINs"""
+        if params.get('elasticity_store', True):
+            self.elasticity_store = ElasticityStore(
+                half_life_days=params.get('elasticity_half_life_days', 30)
+            )
+        else:
+            self.elasticity_store = None
+        self.cross_model = CrossElasticityModel() if params.get('cross_elasticity', True) else None
+        self.buy_box_model = BuyBoxModel() if params.get('buy_box_model', True) else None
         
     def get_connection(self):
-        """Conecta ao PostgreSQL"""
+        """Conecta ao PostgreSQL (ou empresta uma conexão do pool, se houver)"""
+        if self.pool is not None:
+            return self._pooled_connection()
         return psycopg2.connect(**self.db_config, cursor_factory=RealDictCursor)
     
+    @contextmanager
+    def _pooled_connection(self):
+        with self.pool_slots:
+            conn = self.pool.getconn()
+            try:
+                with conn:
+                    yield conn
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+    
     def get_price_history(self, asin, days=90):
         """Busca histórico de preços e vendas"""
+        if self.history_cache is not None:
+            df = self.history_cache.get((asin, days))
+            if df is not None:
+                return df
+        histories = self.load_price_histories([asin], days)
+        df = histories.get(asin, pd.DataFrame(columns=PRICE_HISTORY_COLUMNS))
+        if self.history_cache is not None:
+            self.history_cache.set((asin, days), df)
+        return df
+    
+    def load_price_histories(self, asins, days=90):
+        """Busca o histórico de preços, vendas e competidores de vários ASINs
+        em uma única consulta, separado depois por ASIN em memória.
+        
+        Retorna {asin: DataFrame} no formato de get_price_history; ASINs sem
+        dados ficam de fora.
+        """
+        if not asins:
+            return {}
+            
         query = """
         WITH price_changes AS (
             SELECT 
@@ -51,11 +615,12 @@ class PriceOptimizer:
                 p.updated_at as price_changed_at,
                 LEAD(p.updated_at) OVER (PARTITION BY p.asin ORDER BY p.updated_at) as next_change
             FROM products p
-            WHERE p.asin = %s
+            WHERE p.asin = ANY(%s)
             AND p.updated_at >= CURRENT_DATE - INTERVAL '%s days'
         ),
         sales_with_prices AS (
             SELECT 
+                sm.asin,
                 sm.date,
                 sm.units_ordered,
                 sm.ordered_product_sales,
@@ -63,26 +628,15 @@ class PriceOptimizer:
                 sm.buy_box_percentage,
                 pc.price,
                 pc.cost,
-                (pc.price - pc.cost) / pc.price as margin
+                (pc.price - pc.cost) / NULLIF(pc.price, 0) as margin
             FROM sales_metrics sm
             JOIN price_changes pc ON sm.asin = pc.asin
             AND sm.date >= pc.price_changed_at 
             AND (sm.date < pc.next_change OR pc.next_change IS NULL)
-            WHERE sm.asin = %s
+            WHERE sm.asin = ANY(%s)
             AND sm.date >= CURRENT_DATE - INTERVAL '%s days'
         ),
-        competitor_data AS (
-            SELECT 
-                date(ct.timestamp) as date,
-                MIN(ct.price) as min_competitor_price,
-                AVG(ct.price) as avg_competitor_price,
-                COUNT(DISTINCT ct.competitor_seller_id) as competitor_count,
-                MAX(CASE WHEN ct.is_buy_box_winner THEN ct.price END) as buy_box_price
-            FROM competitor_tracking_advanced ct
-            WHERE ct.asin = %s
-            AND ct.timestamp >= NOW() - INTERVAL '%s days'
-            GROUP BY date(ct.timestamp)
-        )
+        competitor_data AS ({competitor_data})
         SELECT 
             s.*,
             c.min_competitor_price,
@@ -95,123 +649,241 @@ class PriceOptimizer:
                 ELSE 0 
             END as price_gap_pct
         FROM sales_with_prices s
-        LEFT JOIN competitor_data c ON s.date = c.date
-        ORDER BY s.date
-        """
+        LEFT JOIN competitor_data c ON s.asin = c.asin AND s.date = c.date
+        ORDER BY s.asin, s.date
+        """.format(competitor_data=competitor_summary_sql(per_day=True, filter_asins=True))
         
+        asins = list(asins)
+        # Competidores vêm do rollup horário (atualizado pelo worker, ver competitor_rollup.py)
         with self.get_connection() as conn:
-            df = pd.read_sql(query, conn, params=(asin, days, asin, days, asin, days))
+            df = pd.read_sql(query, conn, params=(asins, days, asins, days, days * 24, asins))
             
-        return df
+        return {
+            asin: group.drop(columns='asin').reset_index(drop=True)
+            for asin, group in df.groupby('asin', sort=False)
+        }
     
     def calculate_price_elasticity(self, df):
-        """Calcula elasticidade de preço própria"""
+        """Calcula elasticidade de preço própria
+        
+        Regressão log-log de log(unidades) em log(preço), Buy Box e fim de
+        semana sobre todas as linhas de `df`.
+        """
         if len(df) < 10:  # Mínimo de dados necessários
             return -2.0  # Elasticidade padrão
             
-        # Preparar dados
-        df = df.copy()
-        df['log_price'] = np.log(df['price'])
-        df['log_quantity'] = np.log(df['units_ordered'] + 1)  # +1 para evitar log(0)
-        
-        # Adicionar variáveis de controle
-        df['day_of_week'] = pd.to_datetime(df['date']).dt.dayofweek
-        df['is_weekend'] = df['day_of_week'].isin([5, 6]).astype(int)
-        
-        # Regressão log-log para elasticidade
-        X = df[['log_price', 'buy_box_percentage', 'is_weekend']].values
-        y = df['log_quantity'].values
-        
-        # Remover NaN
-        mask = ~np.isnan(X).any(axis=1) & ~np.isnan(y)
-        X = X[mask]
-        y = y[mask]
-        
-        if len(X) < 10:
-            return -2.0
-            
-        # Treinar modelo
-        model = LinearRegression()
-        model.fit(X, y)
-        
-        # Elasticidade é o coeficiente do log_price
-        elasticity = model.coef_[0]
-        
-        # Limitar elasticidade a valores razoáveis
-        return np.clip(elasticity, -5.0, -0.5)
+        X, y, _ = elasticity_design(df)
+        return solve_elasticity(X.T @ X, X.T @ y, len(X))
     
-    def calculate_cross_elasticity(self, asin, competitor_asins, days=90):
-        """Calcula elasticidade cruzada com competidores"""
-        cross_elasticities = {}
-        
-        # Por simplicidade, assumir elasticidade cruzada pequena
-        # Em produção, calcular com base em dados reais
-        for comp_asin in competitor_asins[:5]:  # Limitar a 5 competidores principais
-            cross_elasticities[comp_asin] = 0.3  # Elasticidade cruzada típica
-            
+    def estimate_elasticity(self, asin, df):
+        """Elasticidade do ASIN: pelo ElasticityStore (só dias novos de
+        `df`) quando configurado, senão recalculada do histórico"""
+        if self.elasticity_cache is not None:
+            elasticity = self.elasticity_cache.get(asin)
+            if elasticity is not None:
+                return elasticity
+        if self.elasticity_store is None:
+            elasticity = self.calculate_price_elasticity(df)
+        else:
+            self.elasticity_store.update(asin, df)
+            elasticity = self.elasticity_store.elasticity(asin)
+        if self.elasticity_cache is not None:
+            self.elasticity_cache.set(asin, elasticity)
+        return elasticity
+    
+    def get_competitor_seller_pairs(self, asins, days=90):
+        """Pares (asin, competitor_seller_id) vistos na janela"""
+        query = """
+        SELECT DISTINCT asin, competitor_seller_id
+        FROM competitor_tracking_advanced
+        WHERE asin = ANY(%s)
+        AND timestamp >= NOW() - INTERVAL '%s days'
+        AND competitor_seller_id IS NOT NULL
+        """
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (list(asins), days))
+                return [(row['asin'], row['competitor_seller_id']) for row in cursor.fetchall()]
+    
+    def refresh_cross_elasticities(self, histories, params):
+        """Reajusta as elasticidades cruzadas se o cache venceu ou não cobre
+        os ASINs de `histories`"""
+        if self.cross_model is None or not histories:
+            return
+        if self.cross_model.is_fresh(histories, params.get('cross_elasticity_ttl_hours', 24)):
+            return
+        seller_pairs = self.get_competitor_seller_pairs(list(histories), params.get('elasticity_window', 90))
+        self.cross_model.fit(histories, seller_pairs, params.get('max_neighbors', 5))
+        self.cross_model.save()
+    
+    def calculate_cross_elasticity(self, asin, competitor_asins=None, days=90):
+        """Elasticidade cruzada com os ASINs vizinhos (ver CrossElasticityModel)"""
+        if self.cross_model is None:
+            return {}
+        cross_elasticities = self.cross_model.get(asin)
+        if competitor_asins is not None:
+            cross_elasticities = {
+                comp_asin: coef for comp_asin, coef in cross_elasticities.items()
+                if comp_asin in competitor_asins
+            }
         return cross_elasticities
     
     def simulate_demand(self, current_price, new_price, current_velocity, elasticity, 
-                       competitor_prices=None, cross_elasticities=None):
-        """Simula demanda com novo preço"""
+                       competitor_prices=None, cross_elasticities=None, cross_demand_change=0.0):
+        """Simula demanda com novo preço
+        
+        Aceita escalares ou arrays (com broadcast do NumPy), para simular uma
+        grade inteira de preços de uma vez. `competitor_prices` é
+        {asin: (preço atual, preço novo)} dos ASINs vizinhos; o efeito já
+        agregado deles também pode vir direto em `cross_demand_change`.
+        """
         # Efeito da mudança de preço próprio
         price_change_pct = (new_price - current_price) / current_price
-        demand_change_pct = price_change_pct * elasticity
+        demand_change_pct = price_change_pct * elasticity + cross_demand_change
         
         # Efeito dos preços dos competidores (se disponível)
         if competitor_prices and cross_elasticities:
-            for comp_asin, comp_price in competitor_prices.items():
-                if comp_asin in cross_elasticities:
-                    # Se nosso preço sobe e do competidor não, perdemos demanda
-                    relative_change = price_change_pct
-                    demand_change_pct += relative_change * cross_elasticities[comp_asin]
+            # Se o vizinho sobe o preço, parte da demanda vem para nós
+            for comp_asin, (comp_current, comp_new) in competitor_prices.items():
+                if comp_asin in cross_elasticities and comp_current:
+                    demand_change_pct = demand_change_pct + (
+                        (comp_new - comp_current) / comp_current * cross_elasticities[comp_asin]
+                    )
         
         # Nova velocidade estimada
         new_velocity = current_velocity * (1 + demand_change_pct)
         
-        return max(0, new_velocity)
+        return np.maximum(0, new_velocity)
+    
+    def refresh_buy_box_model(self, params):
+        """Reajusta o BuyBoxModel se o ajuste salvo passou de
+        `buy_box_model_ttl_hours` (padrão 24). Retorna as métricas do ajuste
+        ou None se o modelo ainda vale."""
+        if self.buy_box_model is None:
+            return None
+        if self.buy_box_model.is_fresh(params.get('buy_box_model_ttl_hours', 24)):
+            return None
+            
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(BuyBoxModel.TRAINING_QUERY, (
+                    params.get('buy_box_training_days', 30),
+                    int(params.get('buy_box_training_snapshots', 100000))
+                ))
+                df = pd.DataFrame(cursor.fetchall())
+        if len(df) == 0 or df['won'].nunique() < 2:
+            return None
+            
+        self.buy_box_model.fit(df)
+        self.buy_box_model.save()
+        return self.buy_box_model.data
+    
+    def fit_buy_box_model(self, params):
+        """Força o ajuste do BuyBoxModel e retorna coeficientes e métricas"""
+        self.configure({**params, 'buy_box_model': True})
+        fitted = self.refresh_buy_box_model({**params, 'buy_box_model_ttl_hours': 0})
+        if fitted is None:
+            return {'success': False, 'error': 'Not enough Buy Box history to fit the model'}
+        return {'success': True, 'data': fitted}
+    
+    def load_seller_rating(self):
+        """Nosso feedback_rating (sellers_cache, AMAZON_SELLER_ID) ou None"""
+        seller_id = os.getenv('AMAZON_SELLER_ID')
+        if not seller_id:
+            return None
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT feedback_rating FROM sellers_cache WHERE seller_id = %s", (seller_id,)
+                )
+                row = cursor.fetchone()
+        return None if not row or row['feedback_rating'] is None else float(row['feedback_rating'])
     
     def calculate_buy_box_probability(self, our_price, competitor_min_price, 
-                                    current_buy_box_pct, rating=4.5):
-        """Estima probabilidade de ganhar Buy Box"""
-        if competitor_min_price is None or competitor_min_price == 0:
-            return current_buy_box_pct / 100
+                                    current_buy_box_pct, rating=None, competitor_count=None):
+        """Estima probabilidade de ganhar Buy Box
+        
+        Aceita escalares ou arrays; onde não há preço de competidor (None,
+        NaN ou 0) vale a Buy Box atual. Com um BuyBoxModel ajustado usa o
+        modelo aprendido (assumindo oferta FBA), senão a curva fixa.
+        `rating` (estrelas ou percentual, ver BuyBoxModel.rating_scale) vem
+        de `seller_rating` quando omitido; sem nenhum dos dois, o modelo usa
+        a mediana do treino e a curva fixa usa 4.5.
+        """
+        if rating is None:
+            rating = self.seller_rating
+        if competitor_min_price is None:
+            competitor_min_price = np.nan
+        competitor_min_price = np.asarray(competitor_min_price, dtype=float)
+        has_competitor = np.nan_to_num(competitor_min_price) > 0
             
-        # Modelo simplificado de Buy Box
         # Fatores: preço relativo, rating, fulfillment (assumindo FBA)
-        price_ratio = our_price / competitor_min_price
+        price_ratio = our_price / np.where(has_competitor, competitor_min_price, 1.0)
         
-        # Função logística para probabilidade
-        # Se preço igual, ~70% de chance (outros fatores)
-        # Se 5% mais caro, ~30% de chance
-        # Se 5% mais barato, ~90% de chance
-        z = -20 * (price_ratio - 1.0) + 0.5 * (rating - 4.0)
-        probability = 1 / (1 + np.exp(-z))
+        if self.buy_box_model is not None and self.buy_box_model.is_fitted:
+            # Nós + competidores do dia
+            seller_count = np.nan_to_num(np.asarray(
+                np.nan if competitor_count is None else competitor_count, dtype=float
+            )) + 1
+            probability = self.buy_box_model.predict(price_ratio, rating, seller_count)
+        else:
+            # Função logística para probabilidade
+            # Se preço igual, ~70% de chance (outros fatores)
+            # Se 5% mais caro, ~30% de chance
+            # Se 5% mais barato, ~90% de chance
+            stars = np.nan_to_num(BuyBoxModel.rating_scale(rating), nan=4.5)
+            z = -20 * (price_ratio - 1.0) + 0.5 * (stars - 4.0)
+            probability = np.clip(1 / (1 + np.exp(-z)), 0.05, 0.95)
         
-        return np.clip(probability, 0.05, 0.95)
+        return np.where(has_competitor, probability, np.asarray(current_buy_box_pct, dtype=float) / 100)
     
-    def optimize_price(self, asin, params):
-        """Otimiza preço para um produto"""
-        # Buscar dados históricos
-        df = self.get_price_history(asin, params.get('elasticity_window', 90))
+    def evaluate_price_grid(self, prices, state, buy_box_weight=0.7):
+        """Avalia uma grade de preços inteira com operações de array.
         
-        if len(df) == 0:
-            return None
-            
+        `prices` tem forma (N, G): G preços para cada um dos N ASINs, e cada
+        campo de `state` (ver stack_states) é um array (N,). Retorna um dict
+        de arrays (N, G) com velocity, revenue, profit, margin e buy_box_prob.
+        """
+        prices = np.asarray(prices, dtype=float)
+        field = lambda name: np.asarray(state[name], dtype=float)[:, None]
+        
+        # Simular demanda
+        new_velocity = self.simulate_demand(
+            field('current_price'), prices, field('current_velocity'), field('elasticity'),
+            cross_demand_change=field('cross_demand_change')
+        )
+        
+        # Estimar Buy Box
+        buy_box_prob = self.calculate_buy_box_probability(
+            prices, field('competitor_min_price'), field('current_buy_box'),
+            competitor_count=field('competitor_count')
+        )
+        
+        # Considerar peso da Buy Box
+        effective_velocity = new_velocity * (buy_box_prob * buy_box_weight + (1 - buy_box_weight))
+        
+        unit_cost = field('unit_cost')
+        return {
+            'price': prices,
+            'velocity': effective_velocity,
+            'revenue': effective_velocity * prices,
+            'profit': effective_velocity * (prices - unit_cost),
+            'margin': (prices - unit_cost) / prices,
+            'buy_box_prob': buy_box_prob
+        }
+    
+    def pricing_state(self, asin, df, params):
+        """Estado atual de um ASIN para a otimização (escalares)"""
         # Dados atuais
         current_state = df.iloc[-1]
         current_price = float(current_state['price'])
-        current_velocity = float(current_state['units_ordered'])
-        current_margin = float(current_state['margin'])
-        current_buy_box = float(current_state['buy_box_percentage'])
         unit_cost = float(current_state['cost'])
         
-        # Calcular elasticidade
-        elasticity = self.calculate_price_elasticity(df)
-        
-        # Competidores
+        # Competidores (NaN quando não há dados do dia)
         competitor_min = current_state['min_competitor_price']
         competitor_avg = current_state['avg_competitor_price']
+        competitor_min = float(competitor_min) if pd.notna(competitor_min) else None
+        competitor_avg = float(competitor_avg) if pd.notna(competitor_avg) else None
         
         # Definir range de preços para testar
         min_margin = params.get('min_margin', 0.15)
@@ -221,71 +893,274 @@ class PriceOptimizer:
         max_price = max(current_price * 1.2, 
                        competitor_avg * 1.1 if competitor_avg else current_price * 1.2)
         
-        # Testar diferentes preços
-        test_prices = np.linspace(min_price, max_price, 50)
-        results = []
+        return {
+            'asin': asin,
+            'current_price': current_price,
+            'current_velocity': float(current_state['units_ordered']),
+            'current_margin': float(current_state['margin']),
+            'current_buy_box': float(current_state['buy_box_percentage']),
+            'unit_cost': unit_cost,
+            'elasticity': self.estimate_elasticity(asin, df),
+            'competitor_min_price': competitor_min,
+            'competitor_avg_price': competitor_avg,
+            'competitor_count': float(current_state['competitor_count']) if pd.notna(current_state['competitor_count']) else None,
+            'min_price': min_price,
+            'max_price': max_price,
+            'history_days': len(df),
+            'cross_demand_change': 0.0,  # Preenchido em optimize_states
+            'history': df  # Para o bootstrap; fora de stack_states
+        }
+    
+    @staticmethod
+    def stack_states(states):
+        """Junta os estados de vários ASINs em arrays (N,) por campo"""
+        fields = [key for key in states[0] if key not in ('asin', 'history')]
+        stacked = {
+            key: np.array([np.nan if state[key] is None else state[key] for state in states], dtype=float)
+            for key in fields
+        }
+        stacked['asin'] = [state['asin'] for state in states]
+        return stacked
+    
+    def grid_search_prices(self, stacked, buy_box_weight=0.7, grid_points=50):
+        """Melhor preço de cada ASIN em uma grade fixa de `grid_points` preços.
         
-        for test_price in test_prices:
-            # Simular demanda
-            new_velocity = self.simulate_demand(
-                current_price, test_price, current_velocity, elasticity
-            )
+        Retorna (prices (N,), avaliações por ASIN).
+        """
+        prices = np.linspace(stacked['min_price'], stacked['max_price'], grid_points, axis=1)
+        profit = self.evaluate_price_grid(prices, stacked, buy_box_weight)['profit']
+        best = np.argmax(profit, axis=1)
+        return prices[np.arange(len(prices)), best], grid_points
+    
+    def golden_search_prices(self, stacked, buy_box_weight=0.7, coarse_points=16, tolerance=0.005):
+        """Preço de lucro máximo de cada ASIN com precisão de centavos.
+        
+        Uma grade grossa de `coarse_points` preços localiza o pico; a busca
+        de seção áurea refina o intervalo entre os vizinhos do melhor ponto
+        até `tolerance`, para todos os ASINs em paralelo (uma avaliação
+        (N, 1) por iteração). O resultado é arredondado ao centavo e nunca é
+        pior que o melhor ponto da grade grossa.
+        
+        Retorna (prices (N,), avaliações por ASIN).
+        """
+        profit_at = lambda prices: self.evaluate_price_grid(
+            prices[:, None], stacked, buy_box_weight
+        )['profit'][:, 0]
+        low, high = stacked['min_price'], stacked['max_price']
+        
+        coarse = np.linspace(low, high, coarse_points, axis=1)
+        coarse_profit = self.evaluate_price_grid(coarse, stacked, buy_box_weight)['profit']
+        best = np.argmax(coarse_profit, axis=1)
+        rows = np.arange(len(coarse))
+        a = coarse[rows, np.maximum(best - 1, 0)]
+        b = coarse[rows, np.minimum(best + 1, coarse_points - 1)]
+        evaluations = coarse_points
+        
+        ratio = (np.sqrt(5) - 1) / 2
+        c = b - ratio * (b - a)
+        d = a + ratio * (b - a)
+        fc, fd = profit_at(c), profit_at(d)
+        evaluations += 2
+        while np.max(b - a) > tolerance:
+            # Onde f(c) >= f(d) o máximo fica em [a, d]; senão em [c, b]
+            left = fc >= fd
+            b = np.where(left, d, b)
+            a = np.where(left, a, c)
+            d_new = np.where(left, c, a + ratio * (b - a))
+            c_new = np.where(left, b - ratio * (b - a), d)
+            new_point = np.where(left, c_new, d_new)
+            new_profit = profit_at(new_point)
+            fc, fd = np.where(left, new_profit, fd), np.where(left, fc, new_profit)
+            c, d = c_new, d_new
+            evaluations += 1
             
-            # Estimar Buy Box
-            buy_box_prob = self.calculate_buy_box_probability(
-                test_price, competitor_min, current_buy_box
-            )
+        # Centavos, dentro dos limites; fica com o melhor entre refinado e grade
+        refined = np.clip(np.round((a + b) / 2, 2), low, high)
+        coarse_best = coarse[rows, best]
+        prices = np.where(profit_at(refined) >= coarse_profit[rows, best], refined, coarse_best)
+        return prices, evaluations + 1
+    
+    def optimize_states(self, states, params):
+        """Otimiza o preço de vários ASINs de uma vez.
+        
+        `price_search` escolhe a busca: 'golden' (padrão, grade grossa +
+        seção áurea, ver golden_search_prices) ou 'grid' (grade fixa de
+        `grid_points` preços, padrão 50). Retorna os resultados na ordem de
+        `states`.
+        """
+        if not states:
+            return []
             
-            # Considerar peso da Buy Box
-            buy_box_weight = params.get('buy_box_weight', 0.7)
-            effective_velocity = new_velocity * (buy_box_prob * buy_box_weight + 
-                                               (1 - buy_box_weight))
+        stacked = self.stack_states(states)
+        buy_box_weight = params.get('buy_box_weight', 0.7)
+        search = lambda: (
+            self.grid_search_prices(stacked, buy_box_weight, int(params.get('grid_points', 50)))
+            if params.get('price_search', 'golden') == 'grid'
+            else self.golden_search_prices(stacked, buy_box_weight)
+        )
+        prices, _ = search()
+        
+        # Efeito cruzado: a mudança sugerida para os vizinhos desloca a demanda
+        # de cada ASIN; uma segunda passada otimiza já com esse efeito
+        if self.cross_model is not None and len(states) > 1:
+            cross = self.cross_model.matrix(stacked['asin'])
+            if cross.nnz:
+                price_change_pct = (prices - stacked['current_price']) / stacked['current_price']
+                stacked['cross_demand_change'] = cross @ price_change_pct
+                prices, _ = search()
+            
+        # Métricas no preço ótimo de cada linha
+        optimal = {
+            key: values[:, 0]
+            for key, values in self.evaluate_price_grid(prices[:, None], stacked, buy_box_weight).items()
+        }
+        
+        resamples = int(params.get('bootstrap_resamples', 200))
+        uncertainty = (
+            self.bootstrap_uncertainty(states, stacked, prices, params)
+            if resamples > 0 else [None] * len(states)
+        )
+        
+        return [
+            self._optimization_result(
+                state, {key: float(values[i]) for key, values in optimal.items()},
+                float(stacked['cross_demand_change'][i]), uncertainty[i]
+            )
+            for i, state in enumerate(states)
+        ]
+    
+    def bootstrap_uncertainty(self, states, stacked, prices, params):
+        """Intervalos de confiança por bootstrap para cada ASIN.
+        
+        Para cada uma das `bootstrap_resamples` (padrão 200) elasticidades
+        reamostradas (ver bootstrap_elasticities), o preço ótimo é buscado
+        de novo e o lucro do preço sugerido é reavaliado, tudo em lote. Os
+        intervalos cobrem `confidence_level` (padrão 0.9). O
+        confidence_score é a fração das reamostragens cujo preço ótimo vai na
+        mesma direção da sugestão (subir, descer ou manter, com ±0,5% de
+        folga).
+        
+        As reamostragens refazem a regressão sem peso sobre a janela de
+        histórico, enquanto a elasticidade usada pode vir do ElasticityStore
+        (com decaimento e outros dias). Por isso as elasticidades
+        reamostradas são deslocadas para a mediana coincidir com a do
+        estado: o intervalo mede a dispersão em torno da estimativa usada.
+        """
+        resamples = int(params.get('bootstrap_resamples', 200))
+        level = params.get('confidence_level', 0.9)
+        buy_box_weight = params.get('buy_box_weight', 0.7)
+        rng = np.random.default_rng(params.get('bootstrap_seed', 0))
+        
+        draws = bootstrap_elasticities(
+            [elasticity_design(state['history'])[:2] for state in states], resamples, rng
+        )
+        draws = np.clip(
+            draws + (stacked['elasticity'] - np.median(draws, axis=1))[:, None], -5.0, -0.5
+        )
+        boot_prices = np.empty_like(draws)
+        boot_profit = np.empty_like(draws)
+        
+        # Blocos de ASINs para limitar a memória das grades (N·B linhas)
+        block = max(1, 50000 // resamples)
+        for start in range(0, len(states), block):
+            rows = slice(start, start + block)
+            repeated = {
+                key: np.repeat(values[rows], resamples)
+                for key, values in stacked.items() if key != 'asin'
+            }
+            repeated['elasticity'] = draws[rows].ravel()
             
-            # Calcular métricas
-            revenue = effective_velocity * test_price
-            profit = effective_velocity * (test_price - unit_cost)
-            margin = (test_price - unit_cost) / test_price
+            if params.get('price_search', 'golden') == 'grid':
+                optimal, _ = self.grid_search_prices(repeated, buy_box_weight, int(params.get('grid_points', 50)))
+            else:
+                optimal, _ = self.golden_search_prices(repeated, buy_box_weight)
+            boot_prices[rows] = optimal.reshape(-1, resamples)
             
-            results.append({
-                'price': test_price,
-                'velocity': effective_velocity,
-                'revenue': revenue,
-                'profit': profit,
-                'margin': margin,
-                'buy_box_prob': buy_box_prob
-            })
+            suggested = np.repeat(prices[rows], resamples)[:, None]
+            boot_profit[rows] = self.evaluate_price_grid(
+                suggested, repeated, buy_box_weight
+            )['profit'][:, 0].reshape(-1, resamples)
         
-        # Encontrar preço ótimo (maximizar lucro)
-        results_df = pd.DataFrame(results)
-        optimal_idx = results_df['profit'].idxmax()
-        optimal = results_df.iloc[optimal_idx]
+        current_price = stacked['current_price'][:, None]
+        boot_profit_change = boot_profit - stacked['current_velocity'][:, None] * (
+            current_price - stacked['unit_cost'][:, None]
+        )
+        direction = lambda price: np.where(
+            np.abs(price - current_price) < 0.005 * current_price, 0, np.sign(price - current_price)
+        )
+        agreement = (direction(boot_prices) == direction(prices[:, None])).mean(axis=1)
+        
+        quantiles = [(1 - level) / 2, (1 + level) / 2]
+        interval = lambda values, digits: np.round(np.quantile(values, quantiles, axis=1).T, digits)
+        elasticity_ci = interval(draws, 3)
+        price_ci = interval(boot_prices, 2)
+        profit_ci = interval(boot_profit_change, 2)
+        return [
+            {
+                'confidence_score': round(float(agreement[i]), 2),
+                'confidence_intervals': {
+                    'level': level,
+                    'elasticity': elasticity_ci[i].tolist(),
+                    'suggested_price': price_ci[i].tolist(),
+                    'expected_profit_change': profit_ci[i].tolist()
+                }
+            }
+            for i in range(len(states))
+        ]
+    
+    def optimize_price(self, asin, params):
+        """Otimiza preço para um produto (bootstrap só com `bootstrap_resamples`)"""
+        params = {'bootstrap_resamples': 0, **params}
+        self.configure(params)
+        self.seller_rating = self.load_seller_rating()
+        
+        # Buscar dados históricos
+        df = self.get_price_history(asin, params.get('elasticity_window', 90))
+        
+        if len(df) == 0:
+            return None
+            
+        result = self.optimize_states([self.pricing_state(asin, df, params)], params)[0]
+        if self.elasticity_store:
+            self.elasticity_store.save()
+        return result
+    
+    def _optimization_result(self, state, optimal, cross_demand_change=0.0, uncertainty=None):
+        """Monta o resultado de um ASIN a partir do ponto ótimo da grade"""
+        current_price = state['current_price']
+        current_velocity = state['current_velocity']
         
         # Calcular mudanças esperadas
         revenue_change = (optimal['revenue'] - current_velocity * current_price)
-        profit_change = (optimal['profit'] - current_velocity * (current_price - unit_cost))
+        profit_change = (optimal['profit'] - current_velocity * (current_price - state['unit_cost']))
         
         return {
-            'asin': asin,
+            'asin': state['asin'],
             'current_price': current_price,
-            'current_buy_box_pct': current_buy_box,
+            'current_buy_box_pct': state['current_buy_box'],
             'current_velocity': current_velocity,
-            'current_margin': current_margin,
-            'elasticity': elasticity,
-            'cross_elasticity': {},  # Simplificado por enquanto
+            'current_margin': state['current_margin'],
+            'elasticity': state['elasticity'],
+            'cross_elasticity': self.calculate_cross_elasticity(state['asin']),
+            'cross_demand_change': round(cross_demand_change, 4),
             'suggested_price': round(optimal['price'], 2),
             'price_range': {
-                'min': round(min_price, 2),
-                'max': round(max_price, 2)
+                'min': round(state['min_price'], 2),
+                'max': round(state['max_price'], 2)
             },
             'expected_buy_box_pct': round(optimal['buy_box_prob'] * 100, 1),
             'expected_velocity': round(optimal['velocity'], 1),
             'expected_revenue_change': round(revenue_change, 2),
             'expected_profit_change': round(profit_change, 2),
-            'competitor_min_price': float(competitor_min) if competitor_min else None,
-            'competitor_avg_price': float(competitor_avg) if competitor_avg else None,
-            'confidence_score': 0.8 if len(df) > 30 else 0.6,
+            'competitor_min_price': state['competitor_min_price'],
+            'competitor_avg_price': state['competitor_avg_price'],
+            'confidence_score': (
+                uncertainty['confidence_score'] if uncertainty
+                else 0.8 if state['history_days'] > 30 else 0.6
+            ),
+            'confidence_intervals': uncertainty['confidence_intervals'] if uncertainty else None,
             'recommendation_reason': self._get_recommendation_reason(
-                current_price, optimal['price'], current_buy_box, optimal['buy_box_prob']
+                current_price, optimal['price'], state['current_buy_box'], optimal['buy_box_prob']
             )
         }
     
@@ -307,10 +1182,49 @@ class PriceOptimizer:
             return "Preço atual próximo do ótimo"
     
     def optimize_all_prices(self, params):
-        """Otimiza preços de todos os produtos elegíveis"""
+        """Otimiza preços de todos os produtos elegíveis
+        
+        `max_products` limita quantos ASINs entram (padrão 50, os de maior
+        receita); None ou 0 otimiza o catálogo inteiro.
+        """
+        products, states, errors = self.load_states(params)
+        
+        # Todas as grades de preço avaliadas de uma vez
+        optimizations = self.optimize_states(states, params)
+        if self.elasticity_store:
+            self.elasticity_store.save()
+        
+        # Ordenar por impacto no lucro
+        optimizations.sort(key=lambda x: abs(x['expected_profit_change']), reverse=True)
+        
+        return {
+            'success': True,
+            'data': {
+                'optimizations': optimizations[:20],  # Top 20
+                'total_products': len(products),
+                'successful_optimizations': len(optimizations),
+                'errors': len(errors),
+                'timestamp': datetime.now().isoformat(),
+                'summary': self._generate_summary(optimizations)
+            }
+        }
+    
+    def load_candidates(self, params):
+        """Carrega os ASINs candidatos e o histórico de todos eles.
+        
+        `max_products` limita quantos ASINs entram (padrão 50, os de maior
+        receita); None ou 0 usa o catálogo inteiro. Retorna (products,
+        {asin: DataFrame}, errors).
+        
+        Se a consulta em lote falhar, cada ASIN é carregado sozinho, para a
+        falha de um não derrubar a execução inteira; os que falham vão para
+        `errors`.
+        """
+        max_products = params.get('max_products', 50)
+        
         # Buscar produtos para otimizar
         query = """
-        SELECT DISTINCT p.asin
+        SELECT p.asin
         FROM products p
         JOIN sales_metrics sm ON p.asin = sm.asin
         WHERE p.active = true
@@ -321,43 +1235,441 @@ class PriceOptimizer:
         HAVING COUNT(DISTINCT sm.date) >= 14
         AND SUM(sm.units_ordered) >= 10
         ORDER BY SUM(sm.ordered_product_sales) DESC
-        LIMIT 50
         """
+        query_params = ()
+        if max_products:
+            query += " LIMIT %s"
+            query_params = (int(max_products),)
         
         with self.get_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(query)
+                cursor.execute(query, query_params)
                 products = cursor.fetchall()
         
-        optimizations = []
+        # Histórico de todos os candidatos em uma consulta só
+        asins = [product['asin'] for product in products]
+        days = params.get('elasticity_window', 90)
         errors = []
+        try:
+            histories = self.load_price_histories(asins, days)
+        except (psycopg2.Error, pd.errors.DatabaseError):
+            histories = {}
+            for asin in asins:
+                try:
+                    histories.update(self.load_price_histories([asin], days))
+                except (psycopg2.Error, pd.errors.DatabaseError) as e:
+                    errors.append({'asin': asin, 'error': f'History load failed: {e}'})
+        return products, histories, errors
+    
+    def load_states(self, params):
+        """Carrega os candidatos e o estado de cada um para a otimização.
+        
+        Retorna (products, states, errors); ver load_candidates.
+        """
+        self.configure(params)
+        products, histories, errors = self.load_candidates(params)
+        
+        states = []
+        
+        # Elasticidades cruzadas são opcionais: se o ajuste falhar, segue sem elas
+        try:
+            self.refresh_cross_elasticities(histories, params)
+        except Exception as e:
+            errors.append({'asin': None, 'error': f'Cross elasticity fit failed: {e}'})
+            self.cross_model = None
+        
+        # Idem para o modelo de Buy Box: sem ajuste, vale a curva fixa
+        try:
+            self.refresh_buy_box_model(params)
+        except Exception as e:
+            errors.append({'asin': None, 'error': f'Buy Box model fit failed: {e}'})
+        try:
+            self.seller_rating = self.load_seller_rating()
+        except Exception as e:
+            errors.append({'asin': None, 'error': f'Seller rating lookup failed: {e}'})
         
         for product in products:
+            df = histories.get(product['asin'])
+            if df is None:
+                continue
             try:
-                optimization = self.optimize_price(product['asin'], params)
-                if optimization:
-                    optimizations.append(optimization)
+                states.append(self.pricing_state(product['asin'], df, params))
             except Exception as e:
                 errors.append({
                     'asin': product['asin'],
                     'error': str(e)
                 })
         
-        # Ordenar por impacto no lucro
-        optimizations.sort(key=lambda x: abs(x['expected_profit_change']), reverse=True)
+        return products, states, errors
+    
+    def benchmark_price_search(self, params):
+        """Compara a grade fixa com a busca por seção áurea nos mesmos ASINs.
+        
+        Uma grade de `reference_points` preços (padrão 5000) serve de
+        referência de precisão. Também mede o bootstrap de incerteza
+        (`bootstrap_resamples`, padrão 200; 0 pula) sobre os preços da busca
+        áurea.
+        """
+        products, states, errors = self.load_states(params)
+        if not states:
+            return {'success': False, 'error': 'No products available for benchmark'}
+            
+        stacked = self.stack_states(states)
+        buy_box_weight = params.get('buy_box_weight', 0.7)
+        searches = {
+            'grid': lambda: self.grid_search_prices(stacked, buy_box_weight, int(params.get('grid_points', 50))),
+            'golden': lambda: self.golden_search_prices(stacked, buy_box_weight),
+            'reference': lambda: self.grid_search_prices(
+                stacked, buy_box_weight, int(params.get('reference_points', 5000))
+            )
+        }
+        
+        report, profits, optimal = {}, {}, {}
+        for name, search in searches.items():
+            started = time.perf_counter()
+            prices, evaluations = search()
+            elapsed = time.perf_counter() - started
+            optimal[name] = prices
+            profits[name] = self.evaluate_price_grid(prices[:, None], stacked, buy_box_weight)['profit'][:, 0]
+            report[name] = {
+                'seconds': round(elapsed, 4),
+                'evaluations_per_asin': evaluations,
+                'total_daily_profit': round(float(profits[name].sum()), 2)
+            }
+            
+        tolerance = 1e-6
+        report['golden']['asins_better_or_equal_than_grid'] = int(
+            (profits['golden'] >= profits['grid'] - tolerance).sum()
+        )
+        report['golden']['max_gap_to_reference'] = round(
+            float(np.max(profits['reference'] - profits['golden'])), 4
+        )
+        report['grid']['max_gap_to_reference'] = round(
+            float(np.max(profits['reference'] - profits['grid'])), 4
+        )
+        
+        resamples = int(params.get('bootstrap_resamples', 200))
+        if resamples > 0:
+            started = time.perf_counter()
+            self.bootstrap_uncertainty(states, stacked, optimal['golden'], {**params, 'price_search': 'golden'})
+            report['bootstrap'] = {
+                'seconds': round(time.perf_counter() - started, 4),
+                'resamples': resamples
+            }
         
         return {
             'success': True,
             'data': {
-                'optimizations': optimizations[:20],  # Top 20
+                'total_products': len(states),
+                'errors': len(errors),
+                'searches': report,
+                'timestamp': datetime.now().isoformat()
+            }
+        }
+    
+    def load_inventory(self, asins):
+        """Estoque disponível (último snapshot) de cada ASIN: {asin: unidades}"""
+        query = """
+        SELECT DISTINCT ON (asin) asin, fulfillable_quantity
+        FROM inventory_snapshots
+        WHERE asin = ANY(%s)
+        ORDER BY asin, snapshot_time DESC
+        """
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (list(asins),))
+                return {
+                    row['asin']: float(row['fulfillable_quantity'] or 0)
+                    for row in cursor.fetchall()
+                }
+    
+    def solve_portfolio(self, stacked, params, inventory=None):
+        """Escolhe um preço por ASIN sob restrições compartilhadas do catálogo.
+        
+        Cada ASIN tem como candidatos o preço atual (coluna 0, "não mudar")
+        e uma grade de `grid_points` preços. As restrições são relaxadas
+        com multiplicadores de Lagrange, e cada ASIN escolhe sozinho o
+        candidato de maior lucro penalizado (um argmax na grade N×G):
+        
+        - estoque: unidades/dia dos ASINs com estoque conhecido ≤ estoque
+          total / `inventory_horizon_days` (multiplicador λ, por bisseção);
+        - margem mínima do portfólio: Σ lucro ≥ `min_blended_margin` · Σ
+          receita (multiplicador μ, por bisseção);
+        - `max_price_changes`: só as K mudanças de maior ganho penalizado
+          entram (resolvido exatamente por ordenação).
+        
+        λ e μ são ajustados alternadamente por `rounds` rodadas. Se nem os
+        preços permitidos que mais reduzem a venda cabem no estoque, a
+        restrição de estoque é inviável: fica de fora (λ = 0) e o plano sai
+        sem ela, marcado `feasible: false`, em vez de penalizado até o
+        limite da bisseção. Retorna (preços (N,), métricas na grade, dict
+        com o estado das restrições).
+        """
+        buy_box_weight = params.get('buy_box_weight', 0.7)
+        min_blended_margin = params.get('min_blended_margin')
+        max_price_changes = params.get('max_price_changes')
+        horizon_days = params.get('inventory_horizon_days', 30)
+        
+        current = stacked['current_price']
+        candidates = np.column_stack([
+            current, np.linspace(stacked['min_price'], stacked['max_price'], int(params.get('grid_points', 50)), axis=1)
+        ])
+        grid = self.evaluate_price_grid(candidates, stacked, buy_box_weight)
+        profit, revenue, velocity = grid['profit'], grid['revenue'], grid['velocity']
+        changed = np.abs(candidates - current[:, None]) >= 0.005
+        rows = np.arange(len(candidates))
+        
+        # Estoque: só os ASINs com snapshot entram na restrição
+        stock = np.array([(inventory or {}).get(asin, np.nan) for asin in stacked['asin']])
+        has_stock = ~np.isnan(stock)
+        capacity = float(np.nansum(stock)) / horizon_days if horizon_days and has_stock.any() else None
+        stock_velocity = velocity * has_stock[:, None]
+        
+        # Menor venda/dia alcançável: cada ASIN no candidato que mais reduz
+        # unidades, respeitando max_price_changes (as K maiores reduções)
+        min_units = None
+        if capacity is not None:
+            base = stock_velocity[:, 0]
+            lowest = np.where(changed, stock_velocity, np.inf).min(axis=1)
+            reduction = np.sort(np.maximum(base - lowest, 0))[::-1]
+            if max_price_changes is not None:
+                reduction = reduction[:int(max_price_changes)]
+            min_units = float(base.sum() - reduction.sum())
+        inventory_feasible = capacity is None or min_units <= capacity + 1e-9
+        
+        def choose(lam, mu):
+            score = profit + mu * (profit - min_blended_margin * revenue if min_blended_margin else 0) - lam * stock_velocity
+            best = np.argmax(np.where(changed, score, -np.inf), axis=1)
+            gain = score[rows, best] - score[:, 0]
+            selected = gain > 0
+            if max_price_changes is not None and selected.sum() > max_price_changes:
+                top = np.argsort(-np.where(selected, gain, -np.inf), kind='stable')[:int(max_price_changes)]
+                selected = np.zeros(len(rows), dtype=bool)
+                selected[top] = True
+            return np.where(selected, best, 0)
+        
+        def totals(choice):
+            return {
+                'units': float(stock_velocity[rows, choice].sum()),
+                'profit': float(profit[rows, choice].sum()),
+                'revenue': float(revenue[rows, choice].sum()),
+                'changes': int((choice > 0).sum())
+            }
+        
+        def inventory_ok(choice):
+            return capacity is None or totals(choice)['units'] <= capacity + 1e-9
+        
+        def margin_ok(choice):
+            t = totals(choice)
+            return not min_blended_margin or t['profit'] >= min_blended_margin * t['revenue'] - 1e-9
+        
+        def bisect(feasible):
+            # Menor multiplicador que torna a restrição viável
+            if feasible(0.0):
+                return 0.0
+            high = 1.0
+            while not feasible(high) and high < 1e6:
+                high *= 4
+            if not feasible(high):
+                return 0.0  # Inviável: não penaliza o plano à toa
+            low = 0.0
+            for _ in range(40):
+                middle = (low + high) / 2
+                low, high = (low, middle) if feasible(middle) else (middle, high)
+            return high
+        
+        lam = mu = 0.0
+        for _ in range(int(params.get('rounds', 4))):
+            previous = (lam, mu)
+            if capacity is not None and inventory_feasible:
+                lam = bisect(lambda value: inventory_ok(choose(value, mu)))
+            if min_blended_margin:
+                mu = bisect(lambda value: margin_ok(choose(lam, value)))
+            if np.allclose(previous, (lam, mu)):
+                break
+        
+        choice = choose(lam, mu)
+        result = totals(choice)
+        status_quo = totals(np.zeros(len(rows), dtype=int))
+        constraints = {
+            'inventory': {
+                'limit_units_per_day': round(capacity, 2) if capacity is not None else None,
+                'units_per_day': round(result['units'], 2),
+                'min_units_per_day': round(min_units, 2) if min_units is not None else None,
+                'multiplier': round(lam, 4),
+                'feasible': inventory_feasible,
+                'satisfied': inventory_ok(choice)
+            },
+            'blended_margin': {
+                'limit': min_blended_margin,
+                'value': round(result['profit'] / result['revenue'], 4) if result['revenue'] else None,
+                'multiplier': round(mu, 4),
+                'satisfied': margin_ok(choice)
+            },
+            'price_changes': {
+                'limit': max_price_changes,
+                'value': result['changes'],
+                'satisfied': max_price_changes is None or result['changes'] <= max_price_changes
+            },
+            'current_daily_profit': round(status_quo['profit'], 2),
+            'planned_daily_profit': round(result['profit'], 2),
+            'current_daily_revenue': round(status_quo['revenue'], 2),
+            'planned_daily_revenue': round(result['revenue'], 2)
+        }
+        optimal = {key: values[rows, choice] for key, values in grid.items()}
+        return candidates[rows, choice], optimal, constraints
+    
+    def optimize_portfolio(self, params):
+        """Otimiza os preços do catálogo em conjunto (ver solve_portfolio).
+        
+        Por padrão usa o catálogo inteiro (`max_products` None) e retorna
+        só os ASINs cujo preço muda.
+        """
+        params = {**params, 'max_products': params.get('max_products')}
+        started = time.perf_counter()
+        products, states, errors = self.load_states(params)
+        if not states:
+            return {'success': False, 'error': 'No products available for portfolio optimization'}
+            
+        stacked = self.stack_states(states)
+        inventory = self.load_inventory(stacked['asin']) if params.get('inventory_horizon_days', 30) else None
+        solver_started = time.perf_counter()
+        prices, optimal, constraints = self.solve_portfolio(stacked, params, inventory)
+        solver_seconds = time.perf_counter() - solver_started
+        if self.elasticity_store:
+            self.elasticity_store.save()
+        
+        optimizations = [
+            self._optimization_result(state, {key: float(values[i]) for key, values in optimal.items()})
+            for i, state in enumerate(states)
+            if abs(prices[i] - state['current_price']) >= 0.005
+        ]
+        optimizations.sort(key=lambda x: x['expected_profit_change'], reverse=True)
+        constraints['feasible'] = all(
+            constraints[name]['satisfied'] for name in ('inventory', 'blended_margin', 'price_changes')
+        )
+        
+        return {
+            'success': True,
+            'data': {
+                'optimizations': optimizations,
+                'portfolio': constraints,
                 'total_products': len(products),
-                'successful_optimizations': len(optimizations),
                 'errors': len(errors),
+                'seconds': round(time.perf_counter() - started, 3),
+                'solver_seconds': round(solver_seconds, 3),
                 'timestamp': datetime.now().isoformat(),
                 'summary': self._generate_summary(optimizations)
             }
         }
     
+    def evaluate_scenarios(self, params):
+        """Compara vários conjuntos de parâmetros sobre os mesmos dados.
+        
+        `scenarios` é uma lista de dicts com `min_margin`, `buy_box_weight`
+        e/ou `elasticity_window` (o que faltar vem de `params`). O histórico
+        é carregado uma vez, na maior janela; cada janela distinta recorta
+        esse histórico em memória e estima a elasticidade uma vez. Todas as
+        linhas cenário×ASIN são otimizadas juntas em uma só busca. Sem
+        ElasticityStore nem elasticidade cruzada, para que os cenários
+        sejam comparáveis entre si.
+        """
+        started = time.perf_counter()
+        scenarios = [{**params, **scenario} for scenario in params.get('scenarios') or [{}]]
+        windows = sorted({int(scenario.get('elasticity_window', 90)) for scenario in scenarios})
+        
+        self.configure({**params, 'elasticity_store': False, 'cross_elasticity': False})
+        products, histories, load_errors = self.load_candidates({**params, 'elasticity_window': windows[-1]})
+        if not histories:
+            return {'success': False, 'error': 'No products available for scenarios'}
+        
+        # Um estado por ASIN para cada janela de elasticidade
+        today = pd.Timestamp(datetime.now().date())
+        window_states, failed = {}, {error['asin'] for error in load_errors}
+        for window in windows:
+            start = today - pd.Timedelta(days=window)
+            window_states[window] = []
+            for asin, df in histories.items():
+                sliced = df[pd.to_datetime(df['date']) >= start].reset_index(drop=True)
+                if len(sliced) == 0:
+                    continue
+                try:
+                    window_states[window].append(self.pricing_state(asin, sliced, params))
+                except Exception:
+                    failed.add(asin)  # Conta uma vez, mesmo falhando em várias janelas
+        
+        # Linhas de todos os cenários empilhadas; min_price e peso da Buy Box por linha
+        blocks, weights, owners = [], [], []
+        for index, scenario in enumerate(scenarios):
+            states = window_states[int(scenario.get('elasticity_window', 90))]
+            if not states:
+                continue
+            block = self.stack_states(states)
+            # Mesma regra de pricing_state, com a margem mínima do cenário
+            block['min_price'] = block['unit_cost'] / (1 - scenario.get('min_margin', 0.15))
+            blocks.append(block)
+            weights.append(np.full(len(states), scenario.get('buy_box_weight', 0.7)))
+            owners.append(np.full(len(states), index))
+        if not blocks:
+            return {'success': False, 'error': 'No history inside the scenario windows'}
+        stacked = {
+            key: (sum((block[key] for block in blocks), []) if key == 'asin'
+                  else np.concatenate([block[key] for block in blocks]))
+            for key in blocks[0]
+        }
+        buy_box_weight = np.concatenate(weights)[:, None]
+        owner = np.concatenate(owners)
+        
+        if params.get('price_search', 'golden') == 'grid':
+            prices, _ = self.grid_search_prices(stacked, buy_box_weight, int(params.get('grid_points', 50)))
+        else:
+            prices, _ = self.golden_search_prices(stacked, buy_box_weight)
+        optimal = {
+            key: values[:, 0]
+            for key, values in self.evaluate_price_grid(prices[:, None], stacked, buy_box_weight).items()
+        }
+        
+        # Mesmas definições de _optimization_result, somadas por cenário
+        current_price, velocity = stacked['current_price'], stacked['current_velocity']
+        revenue_change = optimal['revenue'] - velocity * current_price
+        profit_change = optimal['profit'] - velocity * (current_price - stacked['unit_cost'])
+        price_change_pct = (np.round(prices, 2) - current_price) / current_price * 100
+        per_scenario = lambda values: np.bincount(owner, weights=values, minlength=len(scenarios))
+        counts = np.bincount(owner, minlength=len(scenarios))
+        
+        table = []
+        for index, scenario in enumerate(scenarios):
+            rows = owner == index
+            table.append({
+                'scenario': index,
+                'params': {
+                    key: scenario.get(key, default)
+                    for key, default in (('min_margin', 0.15), ('buy_box_weight', 0.7), ('elasticity_window', 90))
+                },
+                'products': int(counts[index]),
+                'daily_revenue_change': round(float(per_scenario(revenue_change)[index]), 2),
+                'daily_profit_change': round(float(per_scenario(profit_change)[index]), 2),
+                'total_revenue_impact_monthly': round(float(per_scenario(revenue_change)[index]) * 30, 2),
+                'total_profit_impact_monthly': round(float(per_scenario(profit_change)[index]) * 30, 2),
+                'products_to_increase': int((price_change_pct[rows] > 0).sum()),
+                'products_to_decrease': int((price_change_pct[rows] < 0).sum()),
+                'avg_price_change_pct': round(float(price_change_pct[rows].mean()), 1) if counts[index] else None,
+                'avg_elasticity': round(float(stacked['elasticity'][rows].mean()), 2) if counts[index] else None
+            })
+        
+        best = max(table, key=lambda row: row['daily_profit_change'])
+        return {
+            'success': True,
+            'data': {
+                'scenarios': table,
+                'best_scenario': best['scenario'],
+                'total_products': len(products),
+                'errors': len(failed),
+                'seconds': round(time.perf_counter() - started, 3),
+                'timestamp': datetime.now().isoformat()
+            }
+        }
+    
     def _generate_summary(self, optimizations):
         """Gera resumo das otimizações"""
         if not optimizations:
@@ -383,15 +1695,160 @@ class PriceOptimizer:
             )
         }
 
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class PricingService:
+    """Serviço residente para optimize_single.
+    
+    Mantém os imports carregados, um pool de conexões (`pool_size`, padrão
+    4) e caches com TTL do histórico (`history_ttl_seconds`, padrão 300) e
+    da elasticidade (`elasticity_ttl_seconds`, padrão 3600) de cada ASIN.
+    Atende POST com o mesmo JSON do stdin (`optimize_single`,
+    `invalidate_cache`) e GET /health, em `socket_path` (Unix) ou em
+    `host`:`port` (padrão 127.0.0.1:8765).
+    """
+    
+    def __init__(self, params):
+        self.params = params
+        self.optimizer = PriceOptimizer()
+        self.optimizer.configure(params)
+        
+        pool_size = int(params.get('pool_size', 4))
+        self.optimizer.pool = ThreadedConnectionPool(
+            1, pool_size, **self.optimizer.db_config, cursor_factory=RealDictCursor
+        )
+        self.optimizer.pool_slots = threading.BoundedSemaphore(pool_size)
+        self.optimizer.history_cache = TTLCache(params.get('history_ttl_seconds', 300))
+        self.optimizer.elasticity_cache = TTLCache(params.get('elasticity_ttl_seconds', 3600))
+        self.optimizer.seller_rating = self.optimizer.load_seller_rating()
+        self.store_lock = threading.Lock()
+        self.started_at = time.monotonic()
+    
+    def optimize_single(self, asin, params):
+        """Otimiza um ASIN com histórico e elasticidade em cache.
+        
+        Opções de execução (elasticity_store, cross_elasticity) ficam as do
+        início do serviço; as demais vêm de `params`. O bootstrap fica
+        desligado salvo `bootstrap_resamples` explícito.
+        """
+        params = {'bootstrap_resamples': 0, **self.params, **params}
+        df = self.optimizer.get_price_history(asin, params.get('elasticity_window', 90))
+        if len(df) == 0:
+            return None
+        with self.store_lock:
+            state = self.optimizer.pricing_state(asin, df, params)
+        return self.optimizer.optimize_states([state], params)[0]
+    
+    def invalidate(self, asin=None):
+        """Descarta o cache de um ASIN (ou de todos)"""
+        self.optimizer.history_cache.invalidate(None if asin is None else lambda key: key[0] == asin)
+        self.optimizer.elasticity_cache.invalidate(None if asin is None else lambda key: key == asin)
+    
+    def handle(self, input_data):
+        command = input_data.get('command')
+        if command == 'optimize_single':
+            started = time.perf_counter()
+            result = self.optimize_single(input_data.get('asin'), input_data.get('params', {}))
+            if result is None:
+                return {'success': False, 'error': 'No data available for optimization'}
+            return {
+                'success': True,
+                'data': result,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+            }
+        if command == 'invalidate_cache':
+            self.invalidate(input_data.get('asin'))
+            return {'success': True, 'data': {'invalidated': input_data.get('asin') or 'all'}}
+        return {'success': False, 'error': f'Unknown command: {command}'}
+    
+    def health(self):
+        return {
+            'success': True,
+            'data': {
+                'uptime_seconds': round(time.monotonic() - self.started_at, 1),
+                'history_cache': self.optimizer.history_cache.stats(),
+                'elasticity_cache': self.optimizer.elasticity_cache.stats()
+            }
+        }
+    
+    def make_server(self):
+        service = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, result):
+                body = json.dumps(json_safe(result)).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def do_GET(self):
+                if self.path == '/health':
+                    self._reply(200, service.health())
+                else:
+                    self._reply(404, {'success': False, 'error': 'Not found'})
+            
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    result = service.handle(json.loads(self.rfile.read(length) or b'{}'))
+                    self._reply(200, result)
+                except Exception as e:
+                    self._reply(500, {'success': False, 'error': str(e)})
+            
+            def log_message(self, format, *args):
+                pass  # stdout é reservado para a linha de "pronto"
+        
+        socket_path = self.params.get('socket_path')
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            return UnixHTTPServer(socket_path, Handler), socket_path
+        address = (self.params.get('host', '127.0.0.1'), int(self.params.get('port', 8765)))
+        return ThreadingHTTPServer(address, Handler), '%s:%d' % address
+    
+    def serve_forever(self):
+        """Atende até SIGTERM/SIGINT; imprime uma linha JSON quando pronto"""
+        server, address = self.make_server()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(json.dumps({'success': True, 'data': {'listening': address}}), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if self.params.get('socket_path'):
+                os.unlink(self.params['socket_path'])
+            if self.optimizer.elasticity_store:
+                self.optimizer.elasticity_store.save()
+            self.optimizer.pool.closeall()
+
+
 def main():
     """Função principal"""
     # Ler input do Node.js
     input_data = json.loads(sys.stdin.read())
     
+    if input_data.get('command') == 'serve':
+        PricingService(input_data.get('params', {})).serve_forever()
+        return
+    
     optimizer = PriceOptimizer()
     
     if input_data.get('command') == 'optimize_all_prices':
         result = optimizer.optimize_all_prices(input_data.get('params', {}))
+    elif input_data.get('command') == 'optimize_portfolio':
+        result = optimizer.optimize_portfolio(input_data.get('params', {}))
+    elif input_data.get('command') == 'evaluate_scenarios':
+        result = optimizer.evaluate_scenarios(input_data.get('params', {}))
+    elif input_data.get('command') == 'fit_buy_box_model':
+        result = optimizer.fit_buy_box_model(input_data.get('params', {}))
+    elif input_data.get('command') == 'benchmark_price_search':
+        result = optimizer.benchmark_price_search(input_data.get('params', {}))
     elif input_data.get('command') == 'optimize_single':
         result = optimizer.optimize_price(
             input_data.get('asin'),
@@ -408,7 +1865,7 @@ def main():
         }
     
     # Retornar resultado
-    print(json.dumps(result))
+    print(json.dumps(json_safe(result)))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""
+Testes da saída JSON dos scripts: NaN e infinitos precisam virar null, já
+que o JSON.parse do Node.js rejeita NaN. Rodar com: python -m pytest ai/tests
+"""
+
+import io
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import demand_forecast  # noqa: E402
+from json_utils import json_safe  # noqa: E402
+
+
+def test_json_safe_replaces_non_finite_values():
+    value = {
+        'mape': float('nan'),
+        'bounds': (np.float64(1.5), np.inf, -np.inf),
+        'count': np.int64(3),
+        'nested': [{'lower': np.float32('nan')}]
+    }
+    
+    assert json_safe(value) == {
+        'mape': None,
+        'bounds': [1.5, None, None],
+        'count': 3,
+        'nested': [{'lower': None}]
+    }
+
+
+def run_main(monkeypatch, capsys, request, forecasts):
+    """Roda demand_forecast.main com forecast_all_products substituído,
+    devolvendo as linhas de stdout já decodificadas com JSON estrito"""
+    def forecast_all_products(self, params, on_forecast=None):
+        for forecast in forecasts:
+            if on_forecast:
+                on_forecast(forecast)
+        return {'success': True, 'data': {'forecasts': forecasts, 'avg_mape': float('nan')}}
+    
+    monkeypatch.setattr(demand_forecast.DemandForecaster, 'forecast_all_products', forecast_all_products)
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(json.dumps(request)))
+    demand_forecast.main()
+    
+    def reject(constant):
+        raise ValueError(f'{constant} não é JSON válido')
+    return [json.loads(line, parse_constant=reject) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_forecast_output_has_no_nan(monkeypatch, capsys):
+    forecasts = [{'asin': 'B001', 'mape': float('nan'), 'upper_bound': np.float64('inf')}]
+    [result] = run_main(monkeypatch, capsys, {'command': 'forecast_all', 'params': {}}, forecasts)
+    
+    assert result['data']['avg_mape'] is None
+    assert result['data']['forecasts'] == [{'asin': 'B001', 'mape': None, 'upper_bound': None}]
+
+
+def test_forecast_stream_lines_have_no_nan(monkeypatch, capsys):
+    forecasts = [{'asin': 'B001', 'mape': float('nan')}, {'asin': 'B002', 'mape': 12.5}]
+    request = {'command': 'forecast_all', 'params': {'stream': True}}
+    lines = run_main(monkeypatch, capsys, request, forecasts)
+    
+    assert [line['type'] for line in lines] == ['forecast', 'forecast', 'summary']
+    assert lines[0]['data']['mape'] is None
+    assert lines[1]['data']['mape'] == 12.5
+    assert lines[2]['data']['avg_mape'] is None
@@ -0,0 +1,95 @@
+"""
+Testes do solve_portfolio (price_optimization.py) com dados sintéticos,
+sem banco. Rodar com: python -m pytest ai/tests
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from price_optimization import PriceOptimizer  # noqa: E402
+
+
+def make_stacked(n=20, seed=0):
+    """Estados empilhados (ver PriceOptimizer.stack_states) de `n` ASINs"""
+    rng = np.random.default_rng(seed)
+    current_price = rng.uniform(20, 60, n)
+    unit_cost = current_price * rng.uniform(0.4, 0.6, n)
+    return {
+        'asin': [f'B{i:03d}' for i in range(n)],
+        'current_price': current_price,
+        'current_velocity': rng.uniform(5, 20, n),
+        'elasticity': rng.uniform(-3, -1, n),
+        'cross_demand_change': np.zeros(n),
+        'competitor_min_price': np.full(n, np.nan),
+        'current_buy_box': np.full(n, 80.0),
+        'competitor_count': np.zeros(n),
+        'unit_cost': unit_cost,
+        'min_price': unit_cost / 0.85,
+        'max_price': current_price * 1.2
+    }
+
+
+def optimizer():
+    optimizer = PriceOptimizer()
+    optimizer.configure({'elasticity_store': False, 'cross_elasticity': False, 'buy_box_model': False})
+    return optimizer
+
+
+def free_units(stacked, params):
+    """Venda/dia do plano com estoque de sobra (restrição folgada)"""
+    ample = {asin: 1e9 for asin in stacked['asin']}
+    _, _, constraints = optimizer().solve_portfolio(stacked, params, ample)
+    return constraints['inventory']['units_per_day']
+
+
+def test_inventory_constraint_binds_when_feasible():
+    stacked = make_stacked()
+    params = {'inventory_horizon_days': 30}
+    units = free_units(stacked, params)
+    
+    # Estoque para 90% da venda do plano livre: alcançável subindo preços
+    inventory = {asin: units * 0.9 * 30 / len(stacked['asin']) for asin in stacked['asin']}
+    _, _, constraints = optimizer().solve_portfolio(stacked, params, inventory)
+    
+    assert constraints['inventory']['feasible']
+    assert constraints['inventory']['satisfied']
+    assert constraints['inventory']['multiplier'] > 0
+
+
+def test_infeasible_inventory_returns_unpenalized_plan():
+    stacked = make_stacked()
+    params = {'inventory_horizon_days': 30}
+    prices_free, _, free = optimizer().solve_portfolio(stacked, params)
+    
+    # Estoque quase zero: nem o preço máximo de cada ASIN cabe
+    inventory = {asin: 0.01 for asin in stacked['asin']}
+    prices, _, constraints = optimizer().solve_portfolio(stacked, params, inventory)
+    
+    inventory_state = constraints['inventory']
+    assert not inventory_state['feasible']
+    assert not inventory_state['satisfied']
+    assert inventory_state['multiplier'] == 0
+    assert inventory_state['min_units_per_day'] > inventory_state['limit_units_per_day']
+    # Mesmo plano (e lucro) de quando não há restrição de estoque
+    np.testing.assert_allclose(prices, prices_free)
+    assert constraints['planned_daily_profit'] == free['planned_daily_profit']
+
+
+def test_infeasibility_respects_max_price_changes():
+    stacked = make_stacked()
+    units = free_units(stacked, {'inventory_horizon_days': 30})
+    
+    # Alcançável mudando todos os preços, mas não com uma só mudança
+    inventory = {asin: units * 0.8 * 30 / len(stacked['asin']) for asin in stacked['asin']}
+    _, _, unlimited = optimizer().solve_portfolio(stacked, {'inventory_horizon_days': 30}, inventory)
+    _, _, limited = optimizer().solve_portfolio(
+        stacked, {'inventory_horizon_days': 30, 'max_price_changes': 1}, inventory
+    )
+    
+    assert unlimited['inventory']['feasible']
+    assert not limited['inventory']['feasible']
+    assert limited['inventory']['multiplier'] == 0
@@ -0,0 +1,57 @@
+/**
+ * Executar Migration 009: Rollup horário de preços de competidores
+ */
+
+require('dotenv').config();
+const { executeSQL } = require('../DATABASE_ACCESS_CONFIG');
+const fs = require('fs').promises;
+const path = require('path');
+
+async function runMigration009() {
+  console.log('🚀 Executando Migration 009: Rollup de preços de competidores\n');
+  
+  try {
+    // Ler arquivo de migration
+    const migrationPath = path.join(__dirname, '../server/db/migrations/009_create_competitor_price_rollup.sql');
+    const migrationSQL = await fs.readFile(migrationPath, 'utf8');
+    
+    console.log('📄 Migration carregada:', migrationPath);
+    console.log('⏳ Executando migration...');
+    
+    // Executar migration
+    await executeSQL(migrationSQL);
+    
+    console.log('✅ Migration executada com sucesso!\n');
+    
+    // Verificar tabelas criadas
+    const tables = await executeSQL(`
+      SELECT table_name
+      FROM information_schema.tables
+      WHERE table_schema = 'public'
+      AND table_name IN ('competitor_price_hourly', 'competitor_rollup_state')
+      ORDER BY table_name
+    `);
+    
+    console.log('🔍 Tabelas do rollup:');
+    tables.rows.forEach(table => {
+      console.log(`   ✅ ${table.table_name}`);
+    });
+    
+    console.log('\n🎉 MIGRATION 009 CONCLUÍDA COM SUCESSO!');
+    console.log('\n📋 Próximo passo: a primeira atualização agrega todo o histórico');
+    console.log('   echo \'{"command": "refresh"}\' | python ai/scripts/competitor_rollup.py');
+    
+  } catch (error) {
+    console.error('❌ Erro na migration:', error.message);
+    console.log('\n🔧 Possíveis soluções:');
+    console.log('1. Verificar se PostgreSQL está rodando (13 ou superior)');
+    console.log('2. Verificar credenciais de banco no .env');
+  }
+}
+
+// Executar apenas se chamado diretamente
+if (require.main === module) {
+  runMigration009();
+}
+
+module.exports = { runMigration009 };
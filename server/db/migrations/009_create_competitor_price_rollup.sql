@@ -0,0 +1,45 @@
+-- Migration 009: Rollup horário de preços de competidores
+-- Description: Agregado incremental de competitor_tracking_advanced por ASIN e hora,
+-- mantido por ai/scripts/competitor_rollup.py a partir de uma marca d'água de id
+
+-- 1. Agregado por ASIN e hora
+CREATE TABLE IF NOT EXISTS competitor_price_hourly (
+    asin VARCHAR(10) NOT NULL,
+    hour TIMESTAMPTZ NOT NULL,
+
+    -- Preços (média = price_sum / price_count, para poder somar horas)
+    min_price DECIMAL(10,2),
+    price_sum DECIMAL(14,2) NOT NULL DEFAULT 0,
+    price_count INTEGER NOT NULL DEFAULT 0,
+
+    -- Buy Box
+    buy_box_wins INTEGER NOT NULL DEFAULT 0,
+    buy_box_price DECIMAL(10,2),
+    buy_box_seller VARCHAR(255),
+
+    -- Vendedores distintos na hora (contagem distinta em janelas maiores)
+    seller_ids TEXT[] NOT NULL DEFAULT '{}',
+
+    PRIMARY KEY (asin, hour)
+);
+
+CREATE INDEX IF NOT EXISTS idx_comp_price_hourly_hour ON competitor_price_hourly(hour DESC);
+
+-- 2. Marca d'água: último id de competitor_tracking_advanced já agregado.
+-- pending_id/pending_xid guardam o próximo limite e o xmax do snapshot em que
+-- foi lido; o limite só é usado quando as transações abertas naquele momento
+-- terminaram (pg_current_snapshot, PostgreSQL 13+)
+CREATE TABLE IF NOT EXISTS competitor_rollup_state (
+    name VARCHAR(50) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    pending_id BIGINT,
+    pending_xid BIGINT,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Bancos em que a tabela foi criada antes das colunas do limite pendente
+ALTER TABLE competitor_rollup_state ADD COLUMN IF NOT EXISTS pending_id BIGINT;
+ALTER TABLE competitor_rollup_state ADD COLUMN IF NOT EXISTS pending_xid BIGINT;
+
+COMMENT ON TABLE competitor_price_hourly IS 'Preços de competidores agregados por ASIN e hora (incremental)';
+COMMENT ON TABLE competitor_rollup_state IS 'Marca d''água dos rollups incrementais';
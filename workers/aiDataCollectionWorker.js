@@ -204,6 +204,26 @@ class AIDataCollectionWorker {
     }
   }
   
+  /**
+   * Atualiza o rollup horário de preços de competidores.
+   * As análises só leem o rollup, então ele é atualizado aqui antes delas
+   */
+  async refreshCompetitorRollup() {
+    try {
+      const result = await this.executePythonScript('competitor_rollup.py', {
+        command: 'refresh'
+      });
+      
+      if (result.success) {
+        secureLogger.info(`📦 Rollup de competidores atualizado até o id ${result.data.last_id}`);
+      } else {
+        secureLogger.error('Erro ao atualizar rollup de competidores', { error: result.error });
+      }
+    } catch (error) {
+      secureLogger.error('Erro ao atualizar rollup de competidores', { error: error.message });
+    }
+  }
+  
   /**
    * Executa análise com IA
    */
@@ -211,6 +231,8 @@ class AIDataCollectionWorker {
     secureLogger.info('🧠 Iniciando análise com IA...');
     
     try {
+      await this.refreshCompetitorRollup();
+      
       // Executar script Python de análise
       const analysisResult = await this.executePythonScript('analyze_all.py', {
         command: 'generate_insights',
@@ -249,24 +271,38 @@ class AIDataCollectionWorker {
     secureLogger.info('📈 Iniciando previsão de demanda com Prophet...');
     
     try {
-      const result = await this.executePythonScript('demand_forecast.py', {
+      // Modo stream: cada previsão é salva assim que o Python a emite.
+      // Com AI_FORECAST_PERSIST=true o próprio Python grava tudo via COPY
+      // e só o resumo volta
+      const persist = process.env.AI_FORECAST_PERSIST === 'true';
+      const result = await this.executePythonScriptStream('demand_forecast.py', {
         command: 'forecast_all',
         params: {
           forecast_days: 30,
           include_seasonality: true,
-          include_holidays: true
+          include_holidays: true,
+          stream: true,
+          persist
+        }
+      }, async (line) => {
+        if (line.type === 'forecast') {
+          await this.saveDemandForecast(line.data);
         }
       });
       
-      if (result.success) {
-        const forecasts = result.data.forecasts || [];
-        
-        secureLogger.info(`📊 ${forecasts.length} previsões geradas`);
+      if (result.success && result.data.persisted) {
+        secureLogger.info(
+          `📊 ${result.data.persisted.forecasts} previsões gravadas (${result.data.persisted.rows} linhas)`
+        );
+      } else if (result.success) {
+        secureLogger.info(`📊 ${result.data.streamed} previsões geradas`);
         
-        // Salvar previsões no banco
-        for (const forecast of forecasts) {
-          await this.saveDemandForecast(forecast);
+        // MAPE da validação cruzada, calculado depois das previsões
+        for (const [asin, mape] of Object.entries(result.data.mape_updates || {})) {
+          await this.saveForecastAccuracy(asin, mape);
         }
+      } else {
+        secureLogger.error('Erro na previsão de demanda', { error: result.error });
       }
       
     } catch (error) {
@@ -281,6 +317,8 @@ class AIDataCollectionWorker {
     secureLogger.info('💰 Iniciando otimização de preços com ML...');
     
     try {
+      await this.refreshCompetitorRollup();
+      
       const result = await this.executePythonScript('price_optimization.py', {
         command: 'optimize_all_prices',
         params: {
@@ -387,6 +425,95 @@ class AIDataCollectionWorker {
     });
   }
   
+  /**
+   * Executa script Python que responde em NDJSON (uma linha JSON por registro).
+   * Cada linha é passada a `onLine` assim que chega, em ordem; a leitura do
+   * stdout pausa enquanto as linhas anteriores são processadas. Resolve com a
+   * linha de resumo (`type: 'summary'`).
+   */
+  async executePythonScriptStream(scriptName, data, onLine) {
+    return new Promise((resolve, reject) => {
+      const scriptPath = path.join(this.aiScriptsPath, scriptName);
+      
+      const python = spawn(this.pythonPath, [scriptPath], {
+        env: { ...process.env, PYTHONUNBUFFERED: '1' }
+      });
+      
+      let buffer = '';
+      let error = '';
+      let summary = null;
+      let failure = null;
+      let queue = Promise.resolve();
+      
+      const handleLine = async (text) => {
+        if (!text.trim() || failure) {
+          return;
+        }
+        let line;
+        try {
+          line = JSON.parse(text);
+        } catch (e) {
+          throw new Error(`Invalid JSON from Python: ${text}`);
+        }
+        if (line.type === 'summary') {
+          summary = line;
+        } else {
+          await onLine(line);
+        }
+      };
+      
+      // Enviar dados para o script
+      python.stdin.write(JSON.stringify(data));
+      python.stdin.end();
+      
+      python.stdout.on('data', (chunk) => {
+        buffer += chunk.toString();
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        
+        python.stdout.pause();
+        queue = queue
+          .then(async () => {
+            for (const text of lines) {
+              await handleLine(text);
+            }
+          })
+          .catch((e) => {
+            failure = failure || e;
+          })
+          .finally(() => python.stdout.resume());
+      });
+      
+      python.stderr.on('data', (data) => {
+        error += data.toString();
+      });
+      
+      python.on('close', async (code) => {
+        await queue;
+        if (code !== 0) {
+          reject(new Error(`Python script failed: ${error}`));
+          return;
+        }
+        try {
+          await handleLine(buffer);
+        } catch (e) {
+          failure = failure || e;
+        }
+        if (failure) {
+          reject(failure);
+        } else if (!summary) {
+          reject(new Error('Python script ended without a summary line'));
+        } else {
+          resolve(summary);
+        }
+      });
+      
+      python.on('error', (err) => {
+        reject(err);
+      });
+    });
+  }
+  
   /**
    * Salva insight da IA
    */
@@ -421,7 +548,7 @@ class AIDataCollectionWorker {
    */
   async saveDemandForecast(forecast) {
     // Salvar cada dia da previsão
-    for (const daily of forecast.daily_forecasts) {
+    for (const daily of this.expandDailyForecasts(forecast.daily_forecasts)) {
       await executeSQL(`
         INSERT INTO demand_forecasts (
           asin, forecast_date, tenant_id,
@@ -453,7 +580,7 @@ class AIDataCollectionWorker {
         forecast.recommended_stock_level,
         forecast.reorder_point,
         forecast.reorder_quantity,
-        'prophet',
+        forecast.model_name || 'prophet',
         forecast.model_version || '3.0',
         forecast.confidence_level,
         forecast.mape
@@ -461,6 +588,37 @@ class AIDataCollectionWorker {
     }
   }
   
+  /**
+   * Atualiza o MAPE das previsões vigentes de um ASIN
+   */
+  async saveForecastAccuracy(asin, mape) {
+    await executeSQL(`
+      UPDATE demand_forecasts
+      SET mape = $2
+      WHERE asin = $1 AND forecast_date >= CURRENT_DATE
+    `, [asin, mape]);
+  }
+  
+  /**
+   * Converte previsões diárias no formato colunar (listas por campo) em linhas
+   */
+  expandDailyForecasts(dailyForecasts) {
+    if (Array.isArray(dailyForecasts)) {
+      return dailyForecasts;
+    }
+    
+    const fields = Object.keys(dailyForecasts || {});
+    const length = fields.length > 0 ? dailyForecasts[fields[0]].length : 0;
+    
+    return Array.from({ length }, (_, i) => {
+      const daily = {};
+      for (const field of fields) {
+        daily[field] = dailyForecasts[field][i];
+      }
+      return daily;
+    });
+  }
+  
   /**
    * Salva otimização de preço
    */